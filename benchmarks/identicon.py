@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+    Identicon encoding benchmark
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    Compare the PNG size and render time of identicons encoded as 24-bit RGB
+    (the old output) and as a two-colour palette image.
+
+    Usage: python benchmarks/identicon.py [rows] [cols]
+"""
+import sys
+import timeit
+from io import BytesIO
+
+from flask_avatars import IdenticonRenderer
+
+SIZES = (30, 60, 150)
+TEXTS = ['user%d@example.com' % n for n in range(50)]
+
+
+def render(renderer, text, size, rgb):
+    matrix = renderer._create_matrix(renderer._string_to_byte_list(text))
+    image = renderer._draw_image(matrix, size, size, int(size * 0.1))
+    if rgb:
+        image = image.convert('RGB')
+    stream = BytesIO()
+    image.save(stream, format='png', optimize=True)
+    return stream.getvalue()
+
+
+def measure(renderer, size, rgb, number=5):
+    total_bytes = sum(len(render(renderer, text, size, rgb)) for text in TEXTS)
+    seconds = min(timeit.repeat(lambda: [render(renderer, text, size, rgb) for text in TEXTS],
+                                number=1, repeat=number))
+    return total_bytes / float(len(TEXTS)), seconds * 1000 / len(TEXTS)
+
+
+def main(rows=7, cols=7):
+    renderer = IdenticonRenderer(rows=rows, cols=cols, fg_color=(200, 100, 100), bg_color=(240, 240, 240))
+    print('%dx%d grid, mean of %d identicons' % (rows, cols, len(TEXTS)))
+    print('%6s %12s %12s %8s %10s %10s %8s'
+          % ('size', 'RGB bytes', 'P bytes', 'saved', 'RGB ms', 'P ms', 'faster'))
+    for size in SIZES:
+        rgb_bytes, rgb_ms = measure(renderer, size, rgb=True)
+        p_bytes, p_ms = measure(renderer, size, rgb=False)
+        print('%6d %12.0f %12.0f %7.0f%% %10.3f %10.3f %7.1fx' % (
+            size, rgb_bytes, p_bytes, 100 * (1 - p_bytes / rgb_bytes), rgb_ms, p_ms, rgb_ms / p_ms))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""
+    Load test of the example applications
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    Drive the end-to-end flows of examples/crop (upload -> crop -> fetch the
+    three avatars) and examples/identicon (generate -> fetch the three avatars)
+    at a given concurrency, then report the requests per second, the latency
+    percentiles of each step, and the CPU time and peak RSS of each worker.
+
+    A worker is a process that hosts the application. By default each worker
+    drives itself with the Flask test client, with ``--server`` each worker
+    serves the application with the Werkzeug server on localhost and the load
+    comes over HTTP from this process. The avatars were saved in a temporary
+    directory, removed at the end.
+
+    Usage: python benchmarks/loadtest.py [crop|identicon|all] [--flows 200]
+           [--concurrency 8] [--workers 1] [--server]
+"""
+import argparse
+import http.client
+import importlib.util
+import logging
+import multiprocessing
+import os
+import queue
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from io import BytesIO
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'examples')
+SCENARIOS = ('crop', 'identicon')
+#: The crop box, in the upload scaled to ``AVATARS_CROP_BASE_WIDTH``.
+CROP_BOX = {'x': '50', 'y': '40', 'w': '200', 'h': '200'}
+IMG_RE = re.compile(rb'<img src="([^"]+)"')
+
+
+def load_app(scenario, save_path):
+    """Import ``examples/<scenario>/app.py`` and save the avatars in ``save_path``."""
+    name = '%s_example' % scenario
+    spec = importlib.util.spec_from_file_location(name, os.path.join(EXAMPLES, scenario, 'app.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module  # Flask finds the templates by the module
+    spec.loader.exec_module(module)
+    module.app.config['AVATARS_SAVE_PATH'] = save_path
+    return module.app
+
+
+def make_upload(seed, size=(800, 600)):
+    """Return the multipart body and the content type of a JPEG upload, the pixels differ
+    by ``seed``."""
+    from PIL import Image
+
+    img = Image.effect_mandelbrot(size, (-2.0 + seed / 100.0, -1.2, 1.0, 1.2), 64)
+    stream = BytesIO()
+    img.convert('RGB').save(stream, format='jpeg', quality=85)
+    boundary = uuid.uuid4().hex
+    body = b''.join([
+        b'--%s\r\n' % boundary.encode(),
+        b'Content-Disposition: form-data; name="file"; filename="avatar.jpg"\r\n',
+        b'Content-Type: image/jpeg\r\n\r\n',
+        stream.getvalue(),
+        b'\r\n--%s--\r\n' % boundary.encode(),
+    ])
+    return body, 'multipart/form-data; boundary=%s' % boundary
+
+
+def form_body(fields):
+    from urllib.parse import urlencode
+
+    return urlencode(fields).encode(), 'application/x-www-form-urlencoded'
+
+
+class TestClientSession(object):
+    """Requests through the Flask test client, with its own cookies."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body=None, content_type=None):
+        response = self.client.open(path, method=method, data=body, content_type=content_type)
+        try:
+            return response.status_code, response.get_data()
+        finally:
+            response.close()
+
+
+class HTTPSession(object):
+    """Requests over a keep-alive HTTP connection, with the session cookie."""
+
+    def __init__(self, host, port):
+        self.connection = http.client.HTTPConnection(host, port, timeout=60)
+        self.cookie = None
+
+    def request(self, method, path, body=None, content_type=None):
+        headers = {}
+        if content_type is not None:
+            headers['Content-Type'] = content_type
+        if self.cookie is not None:
+            headers['Cookie'] = self.cookie
+        self.connection.request(method, path, body=body, headers=headers)
+        response = self.connection.getresponse()
+        data = response.read()
+        cookie = response.getheader('Set-Cookie')
+        if cookie:
+            self.cookie = cookie.split(';', 1)[0]
+        return response.status, data
+
+
+def run_flow(scenario, session, record, uploads):
+    """Run one flow of the scenario, ``record(step, seconds, ok)`` is called after each request.
+    The crop flow sends one of the prepared ``uploads``."""
+    def request(step, method, path, body=None, content_type=None, expect=200):
+        started = time.perf_counter()
+        try:
+            status, data = session.request(method, path, body, content_type)
+        except Exception:
+            record(step, time.perf_counter() - started, False)
+            return None
+        record(step, time.perf_counter() - started, status == expect)
+        return data if status == expect else None
+
+    if scenario == 'crop':
+        body, content_type = random.choice(uploads)
+        if request('upload', 'POST', '/', body, content_type, expect=302) is None:
+            return
+        body, content_type = form_body(CROP_BOX)
+        page = request('crop', 'POST', '/crop', body, content_type)
+    else:
+        page = request('identicon', 'GET', '/')
+    for url in IMG_RE.findall(page or b''):
+        request('fetch', 'GET', url.decode())
+
+
+def make_uploads(scenario, count=16):
+    """Prepare the uploads before the load, so making them isn't measured."""
+    return [make_upload(seed) for seed in range(count)] if scenario == 'crop' else []
+
+
+def usage():
+    """Return the CPU seconds and the peak RSS (bytes, ``None`` if unknown) of this process."""
+    times = os.times()
+    peak = None
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak *= 1 if sys.platform == 'darwin' else 1024  # kilobytes on Linux
+    if psutil is not None:
+        peak = max(peak or 0, psutil.Process().memory_info().rss)
+    return times.user + times.system, peak
+
+
+def drive(sessions, scenario, flows, uploads):
+    """Run ``flows`` flows over the sessions, one thread per session, return the samples
+    ``(step, seconds, ok)`` and the wall time."""
+    samples = []
+    lock = threading.Lock()
+    counter = iter(range(flows))
+
+    def record(step, seconds, ok):
+        with lock:
+            samples.append((step, seconds, ok))
+
+    def loop(session):
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    return
+            run_flow(scenario, session, record, uploads)
+
+    threads = [threading.Thread(target=loop, args=(session,)) for session in sessions]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.perf_counter() - started
+
+
+def client_worker(scenario, save_path, flows, concurrency, results):
+    app = load_app(scenario, save_path)
+    uploads = make_uploads(scenario)
+    run_flow(scenario, TestClientSession(app), lambda *args: None, uploads)  # warm up
+    cpu = usage()[0]
+    samples, wall = drive([TestClientSession(app) for _ in range(concurrency)], scenario, flows, uploads)
+    results.put((os.getpid(), samples, wall, usage()[0] - cpu, usage()[1]))
+
+
+def server_worker(scenario, save_path, ports, started, stop, results):
+    from werkzeug.serving import make_server
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, load_app(scenario, save_path), threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    ports.put(server.server_port)
+    started.wait()  # measure from the end of the warm up
+    cpu = usage()[0]
+    stop.wait()
+    server.shutdown()
+    thread.join()
+    results.put((os.getpid(), [], None, usage()[0] - cpu, usage()[1]))
+
+
+def collect(results, processes):
+    """Get one output of each worker from the queue, exit if a worker failed."""
+    outputs = []
+    while len(outputs) < len(processes):
+        try:
+            outputs.append(results.get(timeout=1))
+        except queue.Empty:
+            if any(process.exitcode not in (None, 0) for process in processes):
+                for process in processes:
+                    process.terminate()
+                raise SystemExit('A worker exited with an error.')
+    return outputs
+
+
+def percentile(values, p):
+    """The nearest-rank percentile of the sorted values."""
+    index = max(0, min(len(values) - 1, int(round(p / 100.0 * len(values))) - 1))
+    return values[index]
+
+
+def report(scenario, samples, wall, workers, concurrency):
+    total = len(samples)
+    errors = sum(1 for _, _, ok in samples if not ok)
+    print('\n%s: %d requests in %.2fs, %.1f req/s, %d errors (%d worker(s) x %d concurrency)'
+          % (scenario, total, wall, total / wall if wall else 0.0, errors, workers, concurrency))
+    print('%10s %8s %9s %9s %9s %9s %9s' % ('step', 'count', 'req/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+    steps = []
+    for step, _, _ in samples:
+        if step not in steps:
+            steps.append(step)
+    for step in steps:
+        latencies = sorted(seconds * 1000 for name, seconds, _ in samples if name == step)
+        print('%10s %8d %9.1f %9.2f %9.2f %9.2f %9.2f' % (
+            step, len(latencies), len(latencies) / wall if wall else 0.0, percentile(latencies, 50),
+            percentile(latencies, 90), percentile(latencies, 99), latencies[-1]))
+
+
+def report_workers(usages, wall):
+    print('%10s %10s %9s %12s' % ('worker', 'CPU s', 'CPU %', 'peak RSS MB'))
+    for name, cpu, peak in usages:
+        print('%10s %10.2f %8.0f%% %12s' % (name, cpu, 100 * cpu / wall if wall else 0.0,
+                                            '%.1f' % (peak / 1024.0 / 1024) if peak else '?'))
+
+
+def run(scenario, flows, concurrency, workers, server):
+    save_path = tempfile.mkdtemp(prefix='avatars-loadtest-')
+    client = None
+    results = multiprocessing.Queue()
+    try:
+        if not server:
+            processes = [multiprocessing.Process(
+                target=client_worker,
+                args=(scenario, save_path, flows // workers + (index < flows % workers), concurrency, results))
+                for index in range(workers)]
+            for process in processes:
+                process.start()
+            outputs = collect(results, processes)
+            samples = [sample for output in outputs for sample in output[1]]
+            wall = max(output[2] for output in outputs)
+        else:
+            ports, started, stop = multiprocessing.Queue(), multiprocessing.Event(), multiprocessing.Event()
+            processes = [multiprocessing.Process(target=server_worker,
+                                                 args=(scenario, save_path, ports, started, stop, results))
+                         for _ in range(workers)]
+            for process in processes:
+                process.start()
+            addresses = [('127.0.0.1', port) for port in collect(ports, processes)]
+            sessions = [HTTPSession(*addresses[index % workers]) for index in range(concurrency * workers)]
+            uploads = make_uploads(scenario)
+            for address in addresses:
+                run_flow(scenario, HTTPSession(*address), lambda *args: None, uploads)  # warm up
+            started.set()
+            time.sleep(0.1)  # let the workers take the CPU time after warm up
+            cpu = usage()[0]
+            samples, wall = drive(sessions, scenario, flows, uploads)
+            # the load generator shares one GIL, check it's not the bottleneck
+            client = ('client', usage()[0] - cpu, usage()[1])
+            stop.set()
+            outputs = collect(results, processes)
+        for process in processes:
+            process.join()
+    finally:
+        shutil.rmtree(save_path, ignore_errors=True)
+
+    report(scenario, samples, wall, workers, concurrency)
+    usages = sorted((output[0], output[3], output[4]) for output in outputs)
+    report_workers(usages + ([client] if client is not None else []), wall)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test the example applications.')
+    parser.add_argument('scenario', nargs='?', default='all', choices=SCENARIOS + ('all',))
+    parser.add_argument('--flows', type=int, default=200, help='The number of flows of each scenario.')
+    parser.add_argument('--concurrency', type=int, default=8, help='The concurrent flows of each worker.')
+    parser.add_argument('--workers', type=int, default=1, help='The number of worker processes.')
+    parser.add_argument('--server', action='store_true',
+                        help='Serve the application with the Werkzeug server and send the requests over HTTP.')
+    args = parser.parse_args(argv)
+    for scenario in SCENARIOS if args.scenario == 'all' else (args.scenario,):
+        run(scenario, args.flows, args.concurrency, args.workers, args.server)
+
+
+if __name__ == '__main__':
+    main()
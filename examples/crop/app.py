@@ -10,8 +10,8 @@
 """
 import os
 
-from flask import Flask, render_template, url_for, send_from_directory, request, session, redirect
-from flask_avatars import Avatars
+from flask import Flask, render_template, url_for, request, session, redirect, abort
+from flask_avatars import Avatars, InvalidCropError
 
 basedir = os.path.abspath(os.path.dirname(__name__))
 
@@ -27,7 +27,7 @@ avatars = Avatars(app)
 # serve avatar image
 @app.route('/avatars/<path:filename>')
 def get_avatar(filename):
-    return send_from_directory(app.config['AVATARS_SAVE_PATH'], filename)
+    return avatars.send_avatar(filename)
 
 
 @app.route('/', methods=['GET', 'POST'])
@@ -47,7 +47,10 @@ def crop():
         y = request.form.get('y')
         w = request.form.get('w')
         h = request.form.get('h')
-        filenames = avatars.crop_avatar(session['raw_filename'], x, y, w, h)
+        try:
+            filenames = avatars.crop_avatar(session['raw_filename'], x, y, w, h)
+        except InvalidCropError:
+            abort(400)
         url_s = url_for('get_avatar', filename=filenames[0])
         url_m = url_for('get_avatar', filename=filenames[1])
         url_l = url_for('get_avatar', filename=filenames[2])
@@ -11,7 +11,7 @@
 import os
 import uuid
 
-from flask import Flask, render_template, url_for, send_from_directory
+from flask import Flask, render_template, url_for
 from flask_avatars import Avatars, Identicon
 
 basedir = os.path.abspath(os.path.dirname(__name__))
@@ -25,7 +25,7 @@ avatars = Avatars(app)
 # serve avatar image
 @app.route('/avatars/<path:filename>')
 def get_avatar(filename):
-    return send_from_directory(app.config['AVATARS_SAVE_PATH'], filename)
+    return avatars.send_avatar(filename)
 
 
 @app.route('/')
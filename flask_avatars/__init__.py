@@ -7,18 +7,90 @@
     :copyright: © 2018 Grey Li
     :license: MIT, see LICENSE for more details.
 """
+import mimetypes
 import os
+import time
 try:
     from urllib.parse import urlencode
 except ImportError:
     from urllib import urlencode
 
+from io import BytesIO
 from uuid import uuid4
 
-from PIL import Image
-from flask import current_app, Blueprint, url_for
-from markupsafe import Markup
-from .identicon import Identicon  # noqa
+from flask import current_app, abort, Blueprint, Response, url_for, send_file, send_from_directory
+from markupsafe import Markup, escape
+from .identicon import Identicon, IdenticonRenderer  # noqa
+from .limiter import DecodeBudgetExceeded, DecodeLimiter, estimate_memory, estimate_file_memory  # noqa
+from .processing import crop_file, crop_image, resize_and_encode, resize_image, save_upload, write_file, \
+    is_animated, crop_animation, crop_animation_file, parse_box, clamp_box, inspect_file, InvalidCropError  # noqa
+from .sprite import make_sprite, sprite_class
+from .cache import BaseCache, DictCache, RedisCache, SQLiteCache, get_cache, file_cache_key  # noqa
+from .cli import register_commands
+from .models import GravatarMixin, backfill_gravatar_hashes, gravatar_hash  # noqa
+from .warmup import WarmUp  # noqa
+from .utils import RAW_RE, SPRITE_RE, TMP_RE, VARIANT_RE, SingleFlight, iter_avatar_files, get_avatar_path, \
+    shard_path, run_in_executor, file_lock, avatar_name, clamp_size, is_avatar_file, resize_sizes
+
+# Pillow, asyncio, sqlite3 and the migrate, export and dedupe modules are imported in the
+# functions that use them, so apps that only use the URL helpers (gravatar, robohash, etc.)
+# don't pay for them at startup, test_lazy_import checks it.
+
+_flights = SingleFlight()
+
+
+def _animated_filenames(filenames):
+    """The file names of an animated avatar, in WebP."""
+    return [os.path.splitext(filename)[0] + '.webp' for filename in filenames]
+
+
+def _hash_index():
+    """Return the :class:`~flask_avatars.dedupe.HashIndex` of ``AVATARS_DEDUPE_INDEX``, or ``None``."""
+    path = current_app.config['AVATARS_DEDUPE_INDEX']
+    if path is None:
+        return None
+    from .dedupe import get_hash_index
+
+    return get_hash_index(path)
+
+
+def _dedupe_config():
+    """The ``save_path``, ``shard_depth`` and ``threshold`` of :func:`~flask_avatars.dedupe.dedupe_upload`,
+    they are plain values so it can run in an executor without the app context."""
+    config = current_app.config
+    return config['AVATARS_SAVE_PATH'], config['AVATARS_SHARD_DEPTH'], config['AVATARS_DEDUPE_THRESHOLD']
+
+
+def _run_limited(limiter, cost, executor, func, *args):
+    """Call ``func(*args)`` in ``executor`` (or here if it's ``None``) while holding ``cost`` of the
+    decode budget. Run it in a thread, the budget is released after ``func`` returned, even if the
+    awaiting coroutine was cancelled."""
+    with limiter.limit(cost):
+        if executor is None:
+            return func(*args)
+        return executor.submit(func, *args).result()
+
+
+def _write_variants(filenames, paths, outputs, cache, timeout):
+    """Write the encoded variants and put them into ``cache``, return the file names. The arguments
+    are plain values so it can run in a thread without the app context."""
+    for filename, path, data in zip(filenames, paths, outputs):
+        write_file(path, data)
+        if cache is not None:
+            cache.set(file_cache_key(filename), data, timeout=timeout)
+    return filenames
+
+
+def _write_variants_locked(key, lock_path, filenames, paths, outputs, cache, timeout):
+    """:func:`_write_variants` while holding the file lock of ``key``."""
+    with file_lock(lock_path, key):
+        return _write_variants(filenames, paths, outputs, cache, timeout)
+
+
+def _animation_limits():
+    config = current_app.config
+    return (config['AVATARS_ANIMATED_MAX_FRAMES'], config['AVATARS_ANIMATED_MAX_DURATION'],
+            config['AVATARS_ANIMATED_MAX_PIXELS'])
 
 
 class _Avatars(object):
@@ -225,6 +297,106 @@ class _Avatars(object):
   </script>
             ''' % (init_x, init_y, init_size, init_size, min_size_js))
 
+    @staticmethod
+    def img(gravatar=None, identicon=None, filename=None, size='m', alt='', **attrs):
+        """Create a lazily loaded ``<img>`` tag with ``width``, ``height`` and a ``srcset`` covers
+        ``AVATARS_SIZE_TUPLE``, so the browser can reserve the space and pick the right file::
+
+            {{ avatars.img(gravatar=user.email_hash, size='s', alt=user.name) }}
+            {{ avatars.img(identicon=user.username) }}
+            {{ avatars.img(filename=user.avatar_l, size=100, class_='avatar') }}
+
+        Pass one of the sources, the built-in default avatar is used if none was given.
+
+        :param gravatar: The email hash of a Gravatar avatar.
+        :param identicon: The text of an identicon generated by ``Identicon.generate()``.
+        :param filename: Any file name of a cropped avatar, e.g. the ``_m`` file.
+        :param size: The display size, one of ``s``, ``m``, ``l`` (the sizes in ``AVATARS_SIZE_TUPLE``)
+            or pixels.
+        :param alt: The alternate text of the avatar.
+        :param attrs: Other attributes, a trailing underscore was removed (``class_``), and other
+            underscores were replaced with hyphens (``data_id``).
+        """
+        sizes = [int(px) for px in current_app.config['AVATARS_SIZE_TUPLE']]
+        px = sizes['sml'.index(size)] if size in ('s', 'm', 'l') else int(size)
+
+        # (url, width) of each file
+        if gravatar is not None:
+            candidates = [(_Avatars.gravatar(gravatar, size=width), width) for width in sizes]
+        elif identicon is not None:
+            # identicons have a padding
+            candidates = [(url_for('avatars.serve_avatar', filename='%s_%s.png' % (identicon, suffix)),
+                           width + 2 * int(width * 0.1)) for width, suffix in zip(sizes, 'sml')]
+        elif filename is not None:
+            name, ext = avatar_name(filename), os.path.splitext(filename)[1] or '.png'
+            candidates = [(url_for('avatars.serve_avatar', filename='%s_%s%s' % (name, suffix, ext)), width)
+                          for width, suffix in zip(sizes, 'sml')]
+        else:
+            candidates = [(_Avatars.default(suffix), width) for suffix, width in zip('sml', (48, 128, 256))]
+
+        src = next((url for url, width in candidates if width >= px), candidates[-1][0])
+        attributes = [
+            ('src', src),
+            ('srcset', ', '.join('%s %dw' % candidate for candidate in candidates)),
+            ('sizes', '%dpx' % px),
+            ('width', px),
+            ('height', px),
+            ('alt', alt),
+            ('loading', 'lazy'),
+            ('decoding', 'async'),
+        ]
+        attributes += [(key.rstrip('_').replace('_', '-'), value) for key, value in sorted(attrs.items())]
+        return Markup('<img %s>' % ' '.join('%s="%s"' % (key, escape(value)) for key, value in attributes))
+
+    @staticmethod
+    def srcset(filename, size=None, densities=(1, 2, 3)):
+        """Create the ``srcset`` of an avatar, each candidate is resized from the ``_l`` file by the
+        ``avatars.serve_resized`` endpoint, the sizes are clamped to ``AVATARS_RESIZE_SIZES``::
+
+            <img src="{{ url_for('avatars.serve_resized', name=name, px=60) }}"
+                 srcset="{{ avatars.srcset(name, 60) }}" width="60" height="60">
+
+        :param filename: The avatar's name or any of its file names, e.g. ``abc`` or ``abc_m.png``.
+        :param size: The display size in CSS pixels, default to ``AVATARS_SIZE_TUPLE[1]``.
+        :param densities: The pixel densities.
+        """
+        size = int(size or current_app.config['AVATARS_SIZE_TUPLE'][1])
+        name = avatar_name(filename)
+        sizes = resize_sizes(current_app.config)
+        return ', '.join('%s %dx' % (url_for('avatars.serve_resized', name=name, px=clamp_size(size * density, sizes)),
+                                     density) for density in densities)
+
+    @staticmethod
+    def sprite_css(filenames, size=None):
+        """Pack the avatars into a sprite image and create the CSS for it. Use it with
+        ``avatars.sprite_icon()`` to display each avatar with the sprite::
+
+            {{ avatars.sprite_css(filenames) }}
+            {% for filename in filenames %}{{ avatars.sprite_icon(filename) }}{% endfor %}
+
+        :param filenames: The file names of the avatars, e.g. identicons or cropped ``_s`` files.
+        :param size: The size of each avatar in sprite, default to ``AVATARS_SIZE_TUPLE[0]``.
+        """
+        size = int(size or current_app.config['AVATARS_SIZE_TUPLE'][0])
+        sprite_filename, positions = make_sprite(filenames, size=size)
+        url = url_for('avatars.serve_avatar', filename=sprite_filename)
+        rules = ['.avatars-sprite{display:inline-block;width:%dpx;height:%dpx;}' % (size, size)]
+        # the image goes with the position, so several sprites can be used on one page
+        for filename, (x, y) in sorted(positions.items()):
+            rules.append('.%s{background-image:url(%s);background-position:-%dpx -%dpx;}'
+                         % (sprite_class(filename), url, x, y))
+        return Markup('<style>%s</style>' % ''.join(rules))
+
+    @staticmethod
+    def sprite_icon(filename, alt=''):
+        """Create an avatar element that display with the sprite created by ``avatars.sprite_css()``.
+
+        :param filename: The avatar's file name.
+        :param alt: The alternate text of the avatar.
+        """
+        return Markup('<span class="avatars-sprite %s" role="img" aria-label="%s"></span>') % (
+            sprite_class(filename), alt)
+
 
 class Avatars(object):
     def __init__(self, app=None):
@@ -240,6 +412,11 @@ class Avatars(object):
         blueprint = Blueprint('avatars', __name__,
                               static_folder='static',
                               static_url_path='/avatars' + app.static_url_path)
+        # the save path may have other files, serve it only when asked to
+        if app.config.setdefault('AVATARS_SERVE_FILES', False):
+            blueprint.add_url_rule('/avatars/files/<filename>', 'serve_avatar', self.send_avatar)
+            blueprint.add_url_rule('/avatars/files/<name>/<int:px>', 'serve_resized', self.send_resized)
+        register_commands(blueprint.cli, self)
         app.register_blueprint(blueprint)
 
         self.root_path = blueprint.root_path
@@ -252,22 +429,41 @@ class Avatars(object):
 
         app.config.setdefault('AVATARS_SAVE_PATH', None)
         app.config.setdefault('AVATARS_SIZE_TUPLE', (30, 60, 150))
+        app.config.setdefault('AVATARS_RAW_TTL', 24 * 60 * 60)
+        app.config.setdefault('AVATARS_SPRITE_TTL', 24 * 60 * 60)
+        app.config.setdefault('AVATARS_SHARD_DEPTH', 0)
+        app.config.setdefault('AVATARS_RESIZE_SIZES', None)
+        app.config.setdefault('AVATARS_CACHE', None)
+        app.config.setdefault('AVATARS_CACHE_TIMEOUT', None)
+        app.config.setdefault('AVATARS_EXECUTOR', None)
+        app.config.setdefault('AVATARS_LOCK_PATH', None)
+        app.config.setdefault('AVATARS_DEDUPE_INDEX', None)
+        app.config.setdefault('AVATARS_DEDUPE_THRESHOLD', 0)
+        # Decoding
+        app.config.setdefault('AVATARS_DECODE_BUDGET', None)
+        app.config.setdefault('AVATARS_DECODE_TIMEOUT', None)
         # Identicon
         app.config.setdefault('AVATARS_IDENTICON_COLS', 7)
         app.config.setdefault('AVATARS_IDENTICON_ROWS', 7)
         app.config.setdefault('AVATARS_IDENTICON_BG', None)
+        app.config.setdefault('AVATARS_IDENTICON_FG', None)
+        app.config.setdefault('AVATARS_IDENTICON_CACHE', None)
+        app.config.setdefault('AVATARS_IDENTICON_CACHE_SIZE', 64 * 1024 * 1024)
+        app.config.setdefault('AVATARS_WARMUP_INTERVAL', 0.01)
         # Jcrop
         app.config.setdefault('AVATARS_CROP_BASE_WIDTH', 500)
         app.config.setdefault('AVATARS_CROP_INIT_POS', (0, 0))
         app.config.setdefault('AVATARS_CROP_INIT_SIZE', None)
         app.config.setdefault('AVATARS_CROP_PREVIEW_SIZE', None)
         app.config.setdefault('AVATARS_CROP_MIN_SIZE', None)
+        # Animated avatars
+        app.config.setdefault('AVATARS_ANIMATED', False)
+        app.config.setdefault('AVATARS_ANIMATED_MAX_FRAMES', 100)
+        app.config.setdefault('AVATARS_ANIMATED_MAX_DURATION', 10 * 1000)
+        app.config.setdefault('AVATARS_ANIMATED_MAX_PIXELS', 50 * 1000 * 1000)
 
-        # @blueprint.route('/%s/<path:filename>/<size>' % app.config['AVATARS_STATIC_PREFIX'])
-        # def static(filename_m):
-        #     path = current_app.config['AVATARS_SAVE_PATH']
-        #     filename = '%s_%s.png' % (filename, size)
-        #     return send_from_directory(path, filename)
+        self.limiter = DecodeLimiter(budget=app.config['AVATARS_DECODE_BUDGET'],
+                                     timeout=app.config['AVATARS_DECODE_TIMEOUT'])
 
     @staticmethod
     def context_processor():
@@ -281,71 +477,476 @@ class Avatars(object):
         :param img: The image that needs to be resize.
         :param base_width: The width of output image.
         """
-        w_percent = (base_width / float(img.size[0]))
-        h_size = int((float(img.size[1]) * float(w_percent)))
-        img = img.resize((base_width, h_size), Image.BICUBIC)
-        return img
+        return resize_image(img, base_width)
 
     def save_avatar(self, image):
         """Save an avatar as raw image, return new filename.
 
+        If ``AVATARS_DEDUPE_INDEX`` is set and the image is a copy (re-encoded or resized) of a
+        previous upload, nothing will be saved, the file name of the previous upload will be returned.
+
         :param image: The image that needs to be saved.
         """
-        path = current_app.config['AVATARS_SAVE_PATH']
+        index = _hash_index()
+        fingerprint = None
+        if index is not None:
+            from .dedupe import dedupe_upload
+
+            fingerprint, raw = dedupe_upload(index, image, *_dedupe_config(), limiter=self.limiter)
+            if raw is not None:
+                return raw
+
         filename = uuid4().hex + '_raw.png'
-        image.save(os.path.join(path, filename))
+        save_upload(image, get_avatar_path(filename, makedirs=True))
+        if fingerprint is not None:
+            index.add(fingerprint, filename)
         return filename
 
-    def crop_avatar(self, filename, x, y, w, h, uuid_filename = True):
+    def crop_avatar(self, filename, x, y, w, h, uuid_filename=True):
         """Crop avatar with given size, return a list of file name: [filename_s, filename_m, filename_l].
 
+        If ``AVATARS_ANIMATED`` is enabled and the raw image is an animated GIF or WebP, every frame
+        will be cropped, the files are animated WebP (``<name>_s.webp``, etc.).
+
+        The box is clamped to the image (scaled to ``AVATARS_CROP_BASE_WIDTH``), :exc:`InvalidCropError`
+        (a ``ValueError``) will be raised before decoding if it's not numbers, not positive or outside
+        of the image, you can turn it into a 400 response.
+
         :param filename: The raw image's filename.
         :param x: The x-pos to start crop.
         :param y: The y-pos to start crop.
         :param w: The crop width.
         :param h: The crop height.
+        :param uuid_filename: Use a new UUID as the file name, otherwise use the raw image's filename.
+            It's ignored if ``AVATARS_DEDUPE_INDEX`` is set, a raw file may be shared by several users.
         """
-        x = int(x)
-        y = int(y)
-        w = int(w)
-        h = int(h)
+        uuid_filename = self._uuid_filename(filename, uuid_filename)
+        path, box, filenames = self._prepare_crop(filename, x, y, w, h, uuid_filename)
+        if uuid_filename:
+            index, key = _hash_index(), self._crop_key(filename, box)
+            if index is not None and key is not None:
+                cropped = index.get_crop(filename, key)
+                if cropped is not None and all(os.path.exists(get_avatar_path(f)) for f in cropped):
+                    return cropped
+                filenames = self._crop_avatar(path, box, filenames)
+                index.set_crop(filename, key, filenames)
+                return filenames
+            return self._crop_avatar(path, box, filenames)
+        # concurrent crops with the same box were coalesced, the crops to the same files were serialized
+        key = ('crop', get_avatar_path(filenames[0]))
+        return _flights.do(key + (box,), self._crop_avatar_locked, key, path, box, filenames)
+
+    def _crop_avatar_locked(self, key, path, box, filenames):
+        # the files written by another process while waiting for the lock may be cropped with
+        # another box, they're always cropped again
+        with file_lock(current_app.config['AVATARS_LOCK_PATH'], key):
+            return self._crop_avatar(path, box, filenames)
+
+    def _crop_avatar(self, path, box, filenames):
+        from PIL import Image
+
+        config = current_app.config
+        sizes = config['AVATARS_SIZE_TUPLE']
+
+        with Image.open(path) as raw_img:
+            # reject or clamp the box by the header, before any decoding
+            box = clamp_box(raw_img, box, config['AVATARS_CROP_BASE_WIDTH'])
+            with self.limiter.limit(estimate_memory(raw_img)):
+                if config['AVATARS_ANIMATED'] and is_animated(raw_img):
+                    filenames = _animated_filenames(filenames)
+                    outputs = crop_animation(raw_img, box, config['AVATARS_CROP_BASE_WIDTH'], sizes,
+                                             *_animation_limits())
+                else:
+                    cropped_img = crop_image(raw_img, box, config['AVATARS_CROP_BASE_WIDTH'])
+                    outputs = None
+
+        cache = get_cache()
+        for index, (size, filename) in enumerate(zip(sizes, filenames)):
+            data = outputs[index] if outputs is not None else resize_and_encode(cropped_img, size)
+            write_file(get_avatar_path(filename, makedirs=True), data)
+            if cache is not None:
+                cache.set(file_cache_key(filename), data, timeout=config['AVATARS_CACHE_TIMEOUT'])
+        return filenames
+
+    @staticmethod
+    def _crop_key(filename, box):
+        """The key to reuse the variants cropped from a deduplicated upload, ``None`` if the upload
+        is the default avatar."""
+        if not filename:
+            return None
+        config = current_app.config
+        return repr((box, tuple(config['AVATARS_SIZE_TUPLE']), config['AVATARS_CROP_BASE_WIDTH'],
+                     bool(config['AVATARS_ANIMATED'])))
+
+    @staticmethod
+    def _uuid_filename(filename, uuid_filename):
+        """Whether to use a new UUID as the file name of the variants. With deduplication, the
+        users who uploaded the same image share the raw file, their crops can't be named after it."""
+        return uuid_filename or (bool(filename) and current_app.config['AVATARS_DEDUPE_INDEX'] is not None)
 
-        sizes = current_app.config['AVATARS_SIZE_TUPLE']
+    def _prepare_crop(self, filename, x, y, w, h, uuid_filename):
+        """Return the raw image path, the crop box and the output file names."""
+        box = parse_box(x, y, w, h)
 
         if not filename:
             path = os.path.join(self.root_path, 'static/default/default_l.jpg')
         else:
-            path = os.path.join(current_app.config['AVATARS_SAVE_PATH'], filename)
+            path = get_avatar_path(filename)
 
-        raw_img = Image.open(path)
+        if uuid_filename:
+            filename = uuid4().hex
+        return path, box, [filename + '_s.png', filename + '_m.png', filename + '_l.png']
 
-        base_width = current_app.config['AVATARS_CROP_BASE_WIDTH']
+    async def save_avatar_async(self, image):
+        """The awaitable version of :meth:`save_avatar`, the file will be written in a thread pool.
 
-        if raw_img.size[0] >= base_width:
-            raw_img = self.resize_avatar(raw_img, base_width=base_width)
+        :param image: The image that needs to be saved.
+        """
+        index = _hash_index()
+        fingerprint = None
+        if index is not None:
+            from .dedupe import dedupe_upload
 
-        cropped_img = raw_img.crop((x, y, x + w, y + h))
+            fingerprint, raw = await run_in_executor(None, dedupe_upload, index, image, *_dedupe_config(),
+                                                     self.limiter)
+            if raw is not None:
+                return raw
 
-        if uuid_filename:
-            filename = uuid4().hex
+        filename = uuid4().hex + '_raw.png'
+        await run_in_executor(None, save_upload, image, get_avatar_path(filename, makedirs=True))
+        if fingerprint is not None:
+            await run_in_executor(None, index.add, fingerprint, filename)
+        return filename
 
-        avatar_s = self.resize_avatar(cropped_img, base_width=sizes[0])
-        avatar_m = self.resize_avatar(cropped_img, base_width=sizes[1])
-        avatar_l = self.resize_avatar(cropped_img, base_width=sizes[2])
+    async def crop_avatar_async(self, filename, x, y, w, h, uuid_filename=True):
+        """The awaitable version of :meth:`crop_avatar`. The decoding, cropping and encoding run in
+        ``AVATARS_EXECUTOR`` (the three sizes are encoded concurrently), the file writing runs in
+        a thread pool, so the event loop won't be blocked.
 
-        filename_s = filename + '_s.png'
-        filename_m = filename + '_m.png'
-        filename_l = filename + '_l.png'
+        :param filename: The raw image's filename.
+        :param x: The x-pos to start crop.
+        :param y: The y-pos to start crop.
+        :param w: The crop width.
+        :param h: The crop height.
+        :param uuid_filename: Use a new UUID as the file name, otherwise use the raw image's filename.
+            It's ignored if ``AVATARS_DEDUPE_INDEX`` is set, a raw file may be shared by several users.
+        """
+        import asyncio
+
+        uuid_filename = self._uuid_filename(filename, uuid_filename)
+        path, box, filenames = self._prepare_crop(filename, x, y, w, h, uuid_filename)
+        hash_index = _hash_index() if uuid_filename else None
+        key = self._crop_key(filename, box) if hash_index is not None else None
+        if key is not None:
+            cropped = await run_in_executor(None, hash_index.get_crop, filename, key)
+            if cropped is not None and all(os.path.exists(get_avatar_path(f)) for f in cropped):
+                return cropped
+
+        config = current_app.config
+        sizes = config['AVATARS_SIZE_TUPLE']
+        executor = config['AVATARS_EXECUTOR']
+        base_width = config['AVATARS_CROP_BASE_WIDTH']
+        # the keys of the sync version, before the names were changed for an animated avatar
+        lock_key = ('crop', get_avatar_path(filenames[0]))
+        flight_key = lock_key + (box,)
+        # the header was read once, the box was rejected or clamped before any decoding
+        animated, box, cost = await run_in_executor(None, inspect_file, path, box, base_width)
+        if config['AVATARS_ANIMATED'] and animated:
+            filenames = _animated_filenames(filenames)
+            outputs = await run_in_executor(None, _run_limited, self.limiter, cost, executor, crop_animation_file,
+                                            path, box, base_width, sizes, *_animation_limits())
+        else:
+            cropped_img = await run_in_executor(None, _run_limited, self.limiter, cost, executor, crop_file,
+                                                path, box, base_width)
+            outputs = await asyncio.gather(*(run_in_executor(executor, resize_and_encode, cropped_img, size)
+                                             for size in sizes))
 
-        path_s = os.path.join(current_app.config['AVATARS_SAVE_PATH'], filename_s)
-        path_m = os.path.join(current_app.config['AVATARS_SAVE_PATH'], filename_m)
-        path_l = os.path.join(current_app.config['AVATARS_SAVE_PATH'], filename_l)
+        paths = [get_avatar_path(filename, makedirs=True) for filename in filenames]
+        args = (filenames, paths, outputs, get_cache(), config['AVATARS_CACHE_TIMEOUT'])
+        if uuid_filename:
+            filenames = await run_in_executor(None, _write_variants, *args)
+        else:
+            # coalesced and locked with the sync version writing the same files
+            filenames = await run_in_executor(None, _flights.do, flight_key, _write_variants_locked,
+                                              lock_key, config['AVATARS_LOCK_PATH'], *args)
+        if key is not None:
+            await run_in_executor(None, hash_index.set_crop, filename, key, filenames)
+        return filenames
+
+    def clean_avatars(self, live=None, raw_ttl=None, dry_run=False, sprite_ttl=None, callback=None):
+        """Remove orphaned raw uploads and superseded avatar variants, return the number of removed files.
+        The removed file names were passed to ``callback`` and logged (at the debug level) one by one,
+        so the memory usage doesn't depend on the number of files.
+
+        :param live: A set of file names that are still in use. Variants (``_s``, ``_m`` and ``_l`` files)
+            not in this set will be removed, pass ``None`` to keep all the variants. The resized variants
+            (e.g. ``abc_120.png``) were kept if their ``_l`` file is in this set.
+        :param raw_ttl: Remove the raw uploads (and the temporary files left by crashed writes) older than
+            this many seconds, default to ``AVATARS_RAW_TTL``. Raw uploads in ``live`` are always kept.
+        :param dry_run: Only count the files that would be removed, default to ``False``.
+        :param sprite_ttl: Remove the sprites (``<key>_sprite.png`` and ``.json`` files) older than this
+            many seconds, default to ``AVATARS_SPRITE_TTL``, they will be packed again when requested.
+        :param callback: Called with the file name (relative to the save path) of each removed file.
+        """
+        path = current_app.config['AVATARS_SAVE_PATH']
+        if raw_ttl is None:
+            raw_ttl = current_app.config['AVATARS_RAW_TTL']
+        if sprite_ttl is None:
+            sprite_ttl = current_app.config['AVATARS_SPRITE_TTL']
+        live = set(live) if live is not None else None
+        now = time.time()
+        deadline = now - raw_ttl
+
+        removed = 0
+        for entry in iter_avatar_files(path):
+            if live is not None and entry.name in live:
+                continue
+            if RAW_RE.match(entry.name) or TMP_RE.match(entry.name):
+                if entry.stat().st_mtime >= deadline:
+                    continue
+            elif SPRITE_RE.match(entry.name):
+                if entry.stat().st_mtime >= now - sprite_ttl:
+                    continue
+            else:
+                match = VARIANT_RE.match(entry.name)
+                if live is None or match is None:
+                    continue
+                # the resized variants are kept as long as their _l file
+                if match.group('size').isdigit() and match.group('name') + '_l.png' in live:
+                    continue
+            if not dry_run:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:  # removed by someone else
+                    continue
+            relpath = os.path.relpath(entry.path, path)
+            current_app.logger.debug('%s %s.', 'Would remove' if dry_run else 'Removed', relpath)
+            if callback is not None:
+                callback(relpath)
+            removed += 1
+        return removed
+
+    def shard_avatars(self, dry_run=False, callback=None):
+        """Move the avatar files at the top level of ``AVATARS_SAVE_PATH`` into the shard directories,
+        return the number of moved files. The other files (e.g. databases and journals) stay. The moved
+        files were passed to ``callback`` and logged (at the debug level) one by one, so the memory usage
+        doesn't depend on the number of files.
+
+        Run this after you set ``AVATARS_SHARD_DEPTH`` on an existing save path.
+
+        :param dry_run: Only count the files that would be moved, default to ``False``.
+        :param callback: Called with the old and new paths (relative to the save path) of each moved file.
+        """
+        path = current_app.config['AVATARS_SAVE_PATH']
+        depth = current_app.config['AVATARS_SHARD_DEPTH']
+
+        moved = 0
+        if not depth:
+            return moved
+        with os.scandir(path) as it:
+            for entry in it:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                # the sprite maps were saved next to the sprites
+                if not (is_avatar_file(entry.name) or SPRITE_RE.match(entry.name)):
+                    continue
+                target = shard_path(entry.name, depth)
+                if not dry_run:
+                    os.makedirs(os.path.join(path, os.path.dirname(target)), exist_ok=True)
+                    os.replace(entry.path, os.path.join(path, target))
+                current_app.logger.debug('%s %s to %s.', 'Would move' if dry_run else 'Moved', entry.name, target)
+                if callback is not None:
+                    callback(entry.name, target)
+                moved += 1
+        return moved
+
+    def warm_up(self, texts, sizes=None, interval=None, app=None):
+        """Render the identicons of ``texts`` into the cache in a background thread, call it at
+        startup with the busiest users. Return a :class:`~flask_avatars.warmup.WarmUp` object, check
+        its ``progress`` (the rendered count and the elapsed seconds) or ``join()`` it. The progress
+        and the time it took are also logged.
+
+        :param texts: An iterable of texts, a callable returns the iterable (it will be called in the
+            background thread, in an application context), or the path of a file with one text per line.
+        :param sizes: The sizes to render, default to ``AVATARS_SIZE_TUPLE``.
+        :param interval: The seconds to sleep after each text, default to ``AVATARS_WARMUP_INTERVAL``.
+        :param app: The application, default to ``current_app``.
+        """
+        if app is None:
+            app = current_app._get_current_object()
+        config = app.config
+        if (config['AVATARS_CACHE'] is not None or config['AVATARS_IDENTICON_CACHE']) and \
+                not (config['AVATARS_IDENTICON_FG'] and config['AVATARS_IDENTICON_BG']):
+            # the cache key includes the colors, the random ones won't be rendered again
+            app.logger.warning('AVATARS_IDENTICON_FG and AVATARS_IDENTICON_BG are not set, the identicons '
+                               'warmed up with random colors will never be hit in the cache.')
+        return WarmUp(app, texts, sizes=sizes, interval=interval).start()
+
+    def migrate_avatars(self, resize=False, compress_level=9, optimize=True, journal=None, workers=None,
+                        restart=False, callback=None):
+        """Re-encode all the avatar variants in ``AVATARS_SAVE_PATH`` over a process pool, return a
+        :class:`~flask_avatars.migrate.MigrationReport` with the throughput and bytes saved. Each output
+        is verified before it's written atomically, the progress is saved in a journal so an interrupted
+        migration can be resumed, see :func:`~flask_avatars.migrate.migrate`.
+
+        :param resize: Regenerate the ``_s`` and ``_m`` files from the ``_l`` file after
+            ``AVATARS_SIZE_TUPLE`` changed, default to only re-encode. The avatars whose ``_l`` file
+            isn't the large size fail, they can only be cropped or generated again.
+        :param compress_level: The zlib compression level, 0-9.
+        :param optimize: Let the PNG encoder spend more time to make the files smaller.
+        :param journal: The journal file path, default to ``.avatars-migrate.journal`` in the save path.
+        :param workers: The number of worker processes, default to the number of CPUs.
+        :param restart: Ignore the journal and start over.
+        :param callback: Called with ``(relpath, status)`` after each file.
+        """
+        from .migrate import migrate
+
+        config = current_app.config
+        return migrate(config['AVATARS_SAVE_PATH'], sizes=config['AVATARS_SIZE_TUPLE'] if resize else None,
+                       compress_level=compress_level, optimize=optimize, journal=journal, workers=workers,
+                       restart=restart, callback=callback)
+
+    def export_avatars(self, filenames, format='zip', download_name=None):
+        """Return a response that streams the avatar files as a zip or tar archive, for account data
+        exports. The archive was generated chunk by chunk while it's sent, the memory usage doesn't
+        depend on the number or size of the files. Missing files were looked up in ``AVATARS_CACHE``
+        when they're written, or skipped.
+
+        :param filenames: The file names, e.g. the raw upload, the ``_s``, ``_m`` and ``_l`` files and
+            the identicons of a user. :exc:`ValueError` will be raised if any of them isn't an avatar
+            file name (see :func:`~flask_avatars.utils.is_avatar_file`), e.g. ``'../secret.txt'``.
+        :param format: ``'zip'`` or ``'tar'``.
+        :param download_name: The file name of the archive, default to ``avatars.zip`` or ``avatars.tar``.
+        """
+        from .export import iter_tar, iter_zip
+
+        if format not in ('zip', 'tar'):
+            raise ValueError('The format must be zip or tar, got %r.' % format)
+        filenames = list(filenames)
+        for filename in filenames:
+            if not is_avatar_file(filename):
+                raise ValueError('Not an avatar file name: %r.' % filename)
+        # the paths were resolved in the app context, the files are read while the response is sent
+        paths = [(filename, get_avatar_path(filename)) for filename in filenames]
+        cache = get_cache()
+
+        def iter_files():
+            for filename, path in paths:
+                if os.path.exists(path):
+                    yield filename, path
+                elif cache is not None:
+                    data = cache.get(file_cache_key(filename))
+                    if data is not None:
+                        yield filename, data
+
+        files = iter_files()
+        stream = iter_zip(files) if format == 'zip' else iter_tar(files)
+        download_name = download_name or 'avatars.' + format
+        return Response(stream, mimetype='application/zip' if format == 'zip' else 'application/x-tar',
+                        headers={'Content-Disposition': 'attachment; filename="%s"' % download_name})
+
+    def make_sprite(self, filenames, size=None):
+        """Pack the avatars into a sprite image, return the sprite's file name and a dict that maps each
+        file name to its ``(x, y)`` position in the sprite. The sprite was cached by the file name set.
+
+        :param filenames: The file names of the avatars, e.g. identicons or cropped ``_s`` files.
+        :param size: The size of each avatar in sprite, default to ``AVATARS_SIZE_TUPLE[0]``.
+        """
+        return make_sprite(filenames, size=size)
 
-        avatar_s.save(path_s, optimize=True, quality=85)
-        avatar_m.save(path_m, optimize=True, quality=85)
-        avatar_l.save(path_l, optimize=True, quality=85)
+    @staticmethod
+    def send_avatar(filename):
+        """Send an avatar file in ``AVATARS_SAVE_PATH``, works with the sharded layout. If the file
+        doesn't exist on this host, it will be looked up in ``AVATARS_CACHE``. The built-in
+        ``avatars.serve_avatar`` endpoint (enabled by ``AVATARS_SERVE_FILES``) uses this function,
+        you can also call it in your own view. Only the avatar images will be sent, a 404 response
+        will be returned for the other files in the save path (e.g. hidden files and databases),
+        or if ``AVATARS_SAVE_PATH`` is not set.
+
+        :param filename: The avatar's file name.
+        """
+        if current_app.config['AVATARS_SAVE_PATH'] is None or not is_avatar_file(filename):
+            abort(404)
+        relpath = shard_path(filename, current_app.config['AVATARS_SHARD_DEPTH'])
+        cache = get_cache()
+        if cache is not None and not os.path.exists(get_avatar_path(filename)):
+            data = cache.get(file_cache_key(filename))
+            if data is not None:
+                return send_file(BytesIO(data), mimetype=mimetypes.guess_type(filename)[0])
+        return send_from_directory(current_app.config['AVATARS_SAVE_PATH'], relpath)
+
+    def send_resized(self, name, px):
+        """Send the avatar ``name`` resized to ``px`` pixels wide, it's the view of the built-in
+        ``avatars.serve_resized`` endpoint (enabled by ``AVATARS_SERVE_FILES``). The size was clamped
+        to ``AVATARS_RESIZE_SIZES``, the variant was resized from the ``_l`` file on the first request,
+        then saved as ``<name>_<px>.png`` beside it (and stored in ``AVATARS_CACHE`` if set). If ``px``
+        isn't smaller than the ``_l`` file, the ``_l`` file will be sent. The variant will be resized
+        again if the ``_l`` file is newer, e.g. it was cropped again with ``uuid_filename=False``.
+
+        :param name: The avatar's name or any of its file names, e.g. ``abc`` or ``abc_m.png``.
+        :param px: The requested width.
+        """
+        name = avatar_name(name)
+        px = clamp_size(px, resize_sizes(current_app.config))
+        filename = '%s_%d.png' % (name, px)
+        source = name + '_l.png'
+        if current_app.config['AVATARS_SAVE_PATH'] is None or not is_avatar_file(source):
+            abort(404)
+
+        cache = get_cache()
+        exists = os.path.exists(get_avatar_path(filename))
+        if not exists or not self._variant_fresh(source, filename):
+            data = cache.get(file_cache_key(filename)) if cache is not None and not exists else None
+            if data is not None:
+                return send_file(BytesIO(data), mimetype='image/png')
+            # concurrent requests of the same variant were coalesced
+            key = ('resize', get_avatar_path(filename))
+            if not _flights.do(key, self._resize_avatar_locked, key, source, filename, px):
+                return self.send_avatar(source)
+        return self.send_avatar(filename)
 
-        return [filename_s, filename_m, filename_l]
+    @staticmethod
+    def _variant_fresh(source, filename):
+        """Check if the resized ``filename`` exists and isn't older than its ``source`` file (if the
+        source is on this host)."""
+        try:
+            mtime = os.stat(get_avatar_path(filename)).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        try:
+            return os.stat(get_avatar_path(source)).st_mtime_ns <= mtime
+        except FileNotFoundError:
+            return True
+
+    def _resize_avatar_locked(self, key, source, filename, px):
+        lock_path = current_app.config['AVATARS_LOCK_PATH']
+        with file_lock(lock_path, key):
+            # may be resized by another process while waiting for the lock
+            if lock_path is not None and self._variant_fresh(source, filename):
+                return True
+            return self._resize_avatar(source, filename, px)
+
+    def _resize_avatar(self, source, filename, px):
+        """Resize ``source`` to ``px`` and save it as ``filename``, return ``False`` if the source
+        doesn't exist or isn't larger than ``px``."""
+        from PIL import Image
+
+        path = get_avatar_path(source)
+        cache = get_cache()
+        if not os.path.exists(path):
+            data = cache.get(file_cache_key(source)) if cache is not None else None
+            if data is None:
+                return False
+            path = BytesIO(data)
+
+        with Image.open(path) as img, self.limiter.limit(estimate_memory(img)):
+            if img.size[0] <= px:
+                return False
+            data = resize_and_encode(img, px)
+        write_file(get_avatar_path(filename, makedirs=True), data)
+        if cache is not None:
+            cache.set(file_cache_key(filename), data, timeout=current_app.config['AVATARS_CACHE_TIMEOUT'])
+        return True
 
     @staticmethod
     def gravatar(*args, **kwargs):
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_avatars.cache
+    ~~~~~~~~~~~~~~~~~~~
+    Cache for rendered avatars.
+
+    :author: Grey Li <withlihui@gmail.com>
+    :copyright: © 2018 Grey Li
+    :license: MIT, see LICENSE for more details.
+"""
+import threading
+import time
+
+from flask import current_app
+
+from .utils import SQLiteStore, get_store
+
+
+class BaseCache(object):
+    """The interface of avatar cache backends. Values are bytes (``set()`` also accepts
+    other bytes-like objects such as ``memoryview``), ``timeout`` is in seconds and
+    ``None`` means never expire.
+    """
+
+    def get(self, key):
+        """Return the cached value of ``key``, or ``None``.
+
+        :param key: The cache key.
+        """
+        raise NotImplementedError
+
+    def set(self, key, value, timeout=None):
+        """Cache ``value`` (bytes) under ``key``.
+
+        :param key: The cache key.
+        :param value: The bytes to cache.
+        :param timeout: Seconds before the value expire, ``None`` means never expire.
+        """
+        raise NotImplementedError
+
+    def get_many(self, *keys):
+        """Return a list of the cached values of ``keys``, ``None`` for the missing ones.
+
+        :param keys: The cache keys.
+        """
+        return [self.get(key) for key in keys]
+
+
+class DictCache(BaseCache):
+
+    def __init__(self):
+        """A cache in a dict, for a single process or testing."""
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires is not None and expires <= time.time():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, timeout=None):
+        expires = time.time() + timeout if timeout else None
+        with self._lock:
+            self._data[key] = (bytes(value), expires)
+
+
+class RedisCache(BaseCache):
+
+    def __init__(self, client, key_prefix='flask_avatars:'):
+        """A cache in Redis (or any server speaks Redis protocol), shared by all the hosts.
+
+        :param client: A ``redis.Redis`` compatible client, for example
+               ``redis.Redis.from_url('redis://localhost:6379/0')`` or ``fakeredis.FakeRedis()``.
+        :param key_prefix: The prefix of all the keys.
+        """
+        self.client = client
+        self.key_prefix = key_prefix
+
+    def get(self, key):
+        return self.client.get(self.key_prefix + key)
+
+    def set(self, key, value, timeout=None):
+        self.client.set(self.key_prefix + key, value, ex=timeout or None)
+
+    def get_many(self, *keys):
+        if not keys:
+            return []
+        return self.client.mget([self.key_prefix + key for key in keys])
+
+
+class SQLiteCache(SQLiteStore, BaseCache):
+
+    #: Don't refresh the access time of an entry more often than this many seconds,
+    #: so most reads don't need to write.
+    touch_interval = 60
+
+    def __init__(self, path, max_size=64 * 1024 * 1024):
+        """A cache stored in a SQLite database file, shared by all the processes on a host.
+
+        Writes are atomic (in a transaction) and the database uses WAL mode, so it's safe
+        under concurrent readers and writers. When the total size of values exceeds
+        ``max_size``, the least recently used entries will be evicted (expired entries
+        stay until they were evicted).
+
+        :param path: The path of the database file.
+        :param max_size: The max total bytes of the cached values.
+        """
+        super(SQLiteCache, self).__init__(path)
+        self.max_size = max_size
+
+    def _create_tables(self, conn):
+        conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, '
+                     'size INTEGER NOT NULL, atime REAL NOT NULL, expires REAL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS cache_atime ON cache (atime)')
+        conn.execute('CREATE TABLE IF NOT EXISTS meta (id INTEGER PRIMARY KEY CHECK (id = 0), '
+                     'total INTEGER NOT NULL)')
+        conn.execute('INSERT OR IGNORE INTO meta (id, total) VALUES (0, 0)')
+
+    def get(self, key):
+        conn = self._connect()
+        row = conn.execute('SELECT value, atime, expires FROM cache WHERE key = ?', (key,)).fetchone()
+        now = time.time()
+        if row is None or (row[2] is not None and row[2] <= now):
+            return None
+        if now - row[1] > self.touch_interval:
+            conn.execute('UPDATE cache SET atime = ? WHERE key = ?', (now, key))
+        return bytes(row[0])
+
+    def set(self, key, value, timeout=None):
+        conn = self._connect()
+        size = len(value)
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT size FROM cache WHERE key = ?', (key,)).fetchone()
+            old_size = row[0] if row is not None else 0
+            conn.execute('INSERT OR REPLACE INTO cache (key, value, size, atime, expires) VALUES (?, ?, ?, ?, ?)',
+                         (key, memoryview(value), size, now, now + timeout if timeout else None))
+            conn.execute('UPDATE meta SET total = total + ? WHERE id = 0', (size - old_size,))
+            total = conn.execute('SELECT total FROM meta WHERE id = 0').fetchone()[0]
+            while total > self.max_size:
+                rows = conn.execute('SELECT key, size FROM cache WHERE key != ? ORDER BY atime LIMIT 64',
+                                    (key,)).fetchall()
+                if not rows:
+                    break
+                freed = 0
+                for old_key, old_size in rows:
+                    if total - freed <= self.max_size:
+                        break
+                    conn.execute('DELETE FROM cache WHERE key = ?', (old_key,))
+                    freed += old_size
+                conn.execute('UPDATE meta SET total = total - ? WHERE id = 0', (freed,))
+                total -= freed
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def clear(self):
+        """Remove all the cached values."""
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('DELETE FROM cache')
+        conn.execute('UPDATE meta SET total = 0 WHERE id = 0')
+        conn.execute('COMMIT')
+
+
+def get_sqlite_cache(path, max_size):
+    """Return the :class:`SQLiteCache` of ``path``, one instance per process.
+
+    :param path: The path of the database file.
+    :param max_size: The max total bytes of the cached values.
+    """
+    return get_store(SQLiteCache, path, max_size=max_size)
+
+
+def get_cache():
+    """Return the cache backend set in ``AVATARS_CACHE``, or ``None``."""
+    return current_app.config['AVATARS_CACHE']
+
+
+def file_cache_key(filename):
+    """Return the cache key of a saved avatar file, used by the serving endpoint.
+
+    :param filename: The avatar's file name.
+    """
+    return 'file:' + filename
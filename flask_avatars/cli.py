@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_avatars.cli
+    ~~~~~~~~~~~~~~~~~
+    Command line interface, registered as ``flask avatars <command>``.
+
+    :author: Grey Li <withlihui@gmail.com>
+    :copyright: © 2018 Grey Li
+    :license: MIT, see LICENSE for more details.
+"""
+import click
+
+
+def register_commands(cli, avatars):
+    """Register the commands to the blueprint's command group.
+
+    :param cli: The command group, generally ``blueprint.cli``.
+    :param avatars: The :class:`~flask_avatars.Avatars` instance.
+    """
+
+    @cli.command('clean')
+    @click.option('--live', 'live_file', type=click.File('r'),
+                  help='A file contains the in-use file names, one per line. '
+                       'Variants not listed will be removed. Use "-" for stdin.')
+    @click.option('--ttl', type=int, help='Remove raw uploads older than this many seconds.')
+    @click.option('--dry-run', is_flag=True, help='Only print the files that would be removed.')
+    def clean(live_file, ttl, dry_run):
+        """Remove orphaned raw uploads and superseded variants."""
+        live = None
+        if live_file is not None:
+            live = set(line.strip() for line in live_file if line.strip())
+        removed = avatars.clean_avatars(live=live, raw_ttl=ttl, dry_run=dry_run, callback=click.echo)
+        click.echo('%s %d file(s).' % ('Would remove' if dry_run else 'Removed', removed), err=True)
+
+    @cli.command('shard')
+    @click.option('--dry-run', is_flag=True, help='Only print the files that would be moved.')
+    def shard(dry_run):
+        """Move flat avatar files into the shard directories."""
+        def callback(old, new):
+            click.echo('%s -> %s' % (old, new))
+
+        moved = avatars.shard_avatars(dry_run=dry_run, callback=callback)
+        click.echo('%s %d file(s).' % ('Would move' if dry_run else 'Moved', moved), err=True)
+
+    @cli.command('migrate')
+    @click.option('--resize', is_flag=True,
+                  help='Regenerate the _s and _m files from the _l file with AVATARS_SIZE_TUPLE.')
+    @click.option('--compress-level', type=click.IntRange(0, 9), default=9, show_default=True,
+                  help='The zlib compression level.')
+    @click.option('--no-optimize', is_flag=True, help="Don't let the PNG encoder optimize the files.")
+    @click.option('--journal', type=click.Path(dir_okay=False),
+                  help='The journal file to resume from, default to .avatars-migrate.journal in the save path.')
+    @click.option('--workers', type=int, help='The number of worker processes, default to the number of CPUs.')
+    @click.option('--restart', is_flag=True, help='Ignore the journal and start over.')
+    @click.option('-v', '--verbose', is_flag=True, help='Print the status of each file.')
+    def migrate(resize, compress_level, no_optimize, journal, workers, restart, verbose):
+        """Re-encode the avatar files in parallel, resumable."""
+        def callback(relpath, status):
+            if verbose or status == 'failed':
+                click.echo('%s %s' % (status, relpath))
+
+        report = avatars.migrate_avatars(resize=resize, compress_level=compress_level, optimize=not no_optimize,
+                                         journal=journal, workers=workers, restart=restart, callback=callback)
+        for relpath, error in report.errors:
+            click.echo('%s: %s' % (relpath, error), err=True)
+        click.echo(str(report), err=True)
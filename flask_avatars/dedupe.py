@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_avatars.dedupe
+    ~~~~~~~~~~~~~~~~~~~~
+    An index of the perceptual hashes of the uploads, so the copies of the same
+    stock images are stored and cropped only once.
+
+    :author: Grey Li <withlihui@gmail.com>
+    :copyright: © 2018 Grey Li
+    :license: MIT, see LICENSE for more details.
+"""
+import os
+import time
+
+from .utils import SQLiteStore, get_store
+
+#: The 64-bit hash was split into this many 16-bit bands, two hashes within ``BANDS - 1``
+#: bits always have an equal band, so a lookup only compares the rows that share a band.
+BANDS = 4
+#: The max difference of each channel of the average colors of two duplicates.
+COLOR_TOLERANCE = 24
+
+_MASK = (1 << 64) - 1
+
+
+def hamming(a, b):
+    """Return the number of different bits of two hashes.
+
+    :param a: A hash.
+    :param b: Another hash.
+    """
+    return bin(a ^ b).count('1')
+
+
+def _bands(value):
+    return [(value >> (16 * index)) & 0xFFFF for index in range(BANDS)]
+
+
+def _close_colors(a, b):
+    return all(abs(((a >> shift) & 0xFF) - ((b >> shift) & 0xFF)) <= COLOR_TOLERANCE for shift in (0, 8, 16))
+
+
+class HashIndex(SQLiteStore):
+
+    def __init__(self, path):
+        """An index of the upload fingerprints (see :func:`~flask_avatars.processing.fingerprint`)
+        and the variants cropped from them, stored in a SQLite database file shared by all the
+        processes on a host.
+
+        :param path: The path of the database file.
+        """
+        super(HashIndex, self).__init__(path)
+
+    def _create_tables(self, conn):
+        conn.execute('CREATE TABLE IF NOT EXISTS uploads (id INTEGER PRIMARY KEY, hash INTEGER NOT NULL, '
+                     'color INTEGER NOT NULL, raw TEXT NOT NULL, created REAL NOT NULL, %s)'
+                     % ', '.join('b%d INTEGER NOT NULL' % index for index in range(BANDS)))
+        for index in range(BANDS):
+            conn.execute('CREATE INDEX IF NOT EXISTS uploads_b%d ON uploads (b%d)' % (index, index))
+        conn.execute('CREATE INDEX IF NOT EXISTS uploads_raw ON uploads (raw)')
+        conn.execute('CREATE TABLE IF NOT EXISTS crops (upload_id INTEGER NOT NULL, key TEXT NOT NULL, '
+                     'filenames TEXT NOT NULL, PRIMARY KEY (upload_id, key))')
+
+    def find(self, fingerprint, threshold=0):
+        """Return a list of ``(upload_id, raw_filename)`` of the uploads within ``threshold`` bits
+        and of a similar average color, the closest first. They are only the candidates, the
+        images may differ in the details (see :func:`find_duplicate`). With a ``threshold``
+        larger than ``BANDS - 1``, some of the candidates may be missed.
+
+        :param fingerprint: A tuple of ``(hash, color)``.
+        :param threshold: The max Hamming distance of the hashes.
+        """
+        value, color = fingerprint
+        rows = self._connect().execute(
+            'SELECT id, hash, color, raw FROM uploads WHERE %s'
+            % ' OR '.join('b%d = ?' % index for index in range(BANDS)), _bands(value)).fetchall()
+        candidates = []
+        for upload_id, other, other_color, raw in rows:
+            distance = hamming(value, other & _MASK)
+            if distance <= threshold and _close_colors(color, other_color):
+                candidates.append((distance, upload_id, raw))
+        return [candidate[1:] for candidate in sorted(candidates)]
+
+    def add(self, fingerprint, raw):
+        """Record the raw file of an upload, return the upload id.
+
+        :param fingerprint: A tuple of ``(hash, color)``.
+        :param raw: The raw file name.
+        """
+        value, color = fingerprint
+        # SQLite integers are signed
+        signed = value - (1 << 64) if value >= 1 << 63 else value
+        cursor = self._connect().execute(
+            'INSERT INTO uploads (hash, color, raw, created, %s) VALUES (?, ?, ?, ?, %s)'
+            % (', '.join('b%d' % index for index in range(BANDS)), ', '.join('?' * BANDS)),
+            [signed, color, raw, time.time()] + _bands(value))
+        return cursor.lastrowid
+
+    def discard(self, upload_id):
+        """Remove an upload and the variants recorded for it, e.g. its raw file was removed.
+
+        :param upload_id: The id returned by :meth:`add`.
+        """
+        conn = self._connect()
+        conn.execute('DELETE FROM crops WHERE upload_id = ?', (upload_id,))
+        conn.execute('DELETE FROM uploads WHERE id = ?', (upload_id,))
+
+    def get_crop(self, raw, key):
+        """Return the file names cropped from the raw file with ``key``, or ``None``.
+
+        :param raw: The raw file name.
+        :param key: The crop parameters, in a string.
+        """
+        row = self._connect().execute(
+            'SELECT crops.filenames FROM crops JOIN uploads ON crops.upload_id = uploads.id '
+            'WHERE uploads.raw = ? AND crops.key = ?', (raw, key)).fetchone()
+        return row[0].split('/') if row is not None else None
+
+    def set_crop(self, raw, key, filenames):
+        """Record the file names cropped from the raw file with ``key``, nothing will be recorded
+        if the raw file is not in the index.
+
+        :param raw: The raw file name.
+        :param key: The crop parameters, in a string.
+        :param filenames: The cropped file names.
+        """
+        self._connect().execute(
+            'INSERT OR REPLACE INTO crops (upload_id, key, filenames) '
+            'SELECT id, ?, ? FROM uploads WHERE raw = ?', (key, '/'.join(filenames), raw))
+
+
+def find_duplicate(index, fingerprint, thumb, save_path, shard_depth=0, threshold=0, limiter=None):
+    """Return the raw file name of a previous upload of the same image, or ``None``. The
+    candidates found by the fingerprint were checked against the thumbnails of their raw
+    files (see :func:`~flask_avatars.processing.same_image`), the uploads whose raw file
+    was removed were discarded from the index. The raw file of the duplicate was touched,
+    so it's kept by :meth:`~flask_avatars.Avatars.clean_avatars`.
+
+    :param index: A :class:`HashIndex`.
+    :param fingerprint: The fingerprint of the upload.
+    :param thumb: The thumbnail of the upload.
+    :param save_path: The directory of the avatars.
+    :param shard_depth: The depth of the shard directories.
+    :param threshold: The max Hamming distance of the hashes.
+    :param limiter: A :class:`~flask_avatars.limiter.DecodeLimiter` to admit the decoding.
+    """
+    from .processing import open_thumbnail, same_image
+    from .utils import shard_path
+
+    for upload_id, raw in index.find(fingerprint, threshold):
+        path = os.path.join(save_path, shard_path(raw, shard_depth))
+        try:
+            other = open_thumbnail(path, limiter)
+        except (IOError, OSError):
+            if not os.path.exists(path):
+                index.discard(upload_id)
+            continue
+        except Exception:  # undecodable or over the budget, not a duplicate
+            continue
+        if same_image(thumb, other):
+            try:
+                os.utime(path, None)
+            except OSError:  # removed just now
+                continue
+            return raw
+    return None
+
+
+def dedupe_upload(index, image, save_path, shard_depth=0, threshold=0, limiter=None):
+    """Return a tuple of the fingerprint of an upload (``None`` if it can't be decoded) and the
+    raw file name of its duplicate (see :func:`find_duplicate`), or ``None``.
+
+    :param index: A :class:`HashIndex`.
+    :param image: A ``FileStorage`` (or a file object) or a PIL image.
+    :param save_path: The directory of the avatars.
+    :param shard_depth: The depth of the shard directories.
+    :param threshold: The max Hamming distance of the hashes.
+    :param limiter: A :class:`~flask_avatars.limiter.DecodeLimiter` to admit the decoding.
+    """
+    from .processing import fingerprint, upload_thumbnail
+
+    thumb = upload_thumbnail(image, limiter)
+    if thumb is None:
+        return None, None
+    value = fingerprint(thumb)
+    return value, find_duplicate(index, value, thumb, save_path, shard_depth, threshold, limiter)
+
+
+def get_hash_index(path):
+    """Return the :class:`HashIndex` of ``path``, one instance per process.
+
+    :param path: The path of the database file.
+    """
+    return get_store(HashIndex, path)
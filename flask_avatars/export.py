@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_avatars.export
+    ~~~~~~~~~~~~~~~~~~~~
+    Stream avatar files as a zip or tar archive, chunk by chunk.
+
+    :author: Grey Li <withlihui@gmail.com>
+    :copyright: © 2018 Grey Li
+    :license: MIT, see LICENSE for more details.
+"""
+import os
+import tarfile
+import time
+import zipfile
+
+#: The bytes read from a file at a time.
+CHUNK_SIZE = 64 * 1024
+
+
+class _Pipe(object):
+    """A write-only, non-seekable file, the written bytes were taken out with :meth:`read_all`."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def read_all(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _read_chunks(path, chunk_size):
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def iter_zip(files, chunk_size=CHUNK_SIZE):
+    """Yield a zip archive of the files chunk by chunk, only one chunk of a file is in memory at a time.
+
+    :param files: An iterable of ``(arcname, path)`` tuples, ``path`` can also be bytes (the content).
+    :param chunk_size: The bytes read from a file at a time.
+    """
+    pipe = _Pipe()
+    # a non-seekable file, zipfile writes the sizes and CRC after the data
+    with zipfile.ZipFile(pipe, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for arcname, path in files:
+            if isinstance(path, bytes):
+                info, chunks = zipfile.ZipInfo(arcname, time.localtime()[:6]), [path]
+            else:
+                info = zipfile.ZipInfo.from_file(path, arcname)
+                chunks = _read_chunks(path, chunk_size)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with archive.open(info, 'w') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    data = pipe.read_all()
+                    if data:
+                        yield data
+            data = pipe.read_all()
+            if data:
+                yield data
+    # the central directory
+    yield pipe.read_all()
+
+
+def iter_tar(files, chunk_size=CHUNK_SIZE):
+    """Yield a tar archive of the files chunk by chunk, only one chunk of a file is in memory at a time.
+
+    The headers were created by ``tarfile``, the data was copied in chunks between them, as a
+    ``tarfile.open(mode='w|')`` stream does.
+
+    :param files: An iterable of ``(arcname, path)`` tuples, ``path`` can also be bytes (the content).
+    :param chunk_size: The bytes read from a file at a time.
+    """
+    written = 0
+    for arcname, path in files:
+        info = tarfile.TarInfo(arcname)
+        if isinstance(path, bytes):
+            info.size, info.mtime, chunks = len(path), int(time.time()), [path]
+        else:
+            stat = os.stat(path)
+            info.size, info.mtime, chunks = stat.st_size, int(stat.st_mtime), _read_chunks(path, chunk_size)
+        info.mode = 0o644
+        header = info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+        yield header
+        size = 0
+        for chunk in chunks:
+            chunk = chunk[:info.size - size]  # the file grew while reading
+            size += len(chunk)
+            yield chunk
+        if size < info.size:  # the file shrank while reading
+            yield tarfile.NUL * (info.size - size)
+        remainder = info.size % tarfile.BLOCKSIZE
+        padding = tarfile.BLOCKSIZE - remainder if remainder else 0
+        yield tarfile.NUL * padding
+        written += len(header) + info.size + padding
+    # the end of archive, two empty blocks, padded to a record
+    end = tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+    written += len(end)
+    yield end + tarfile.NUL * (-written % tarfile.RECORDSIZE)
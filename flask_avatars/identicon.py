@@ -11,47 +11,92 @@
     Ths file was based on randomavatar(https://pypi.org/project/randomavatar/) by Richard O'Dwyer and
     modified under it's Creative Commons Attribution-Noncommercial-Share Alike license © Richard O'Dwyer.
 """
+import functools
 import hashlib
 import math
 import os
+import pickle
 import random
+import time
 from io import BytesIO
 
-from PIL import Image, ImageDraw
 from flask import current_app
 
+from .cache import get_cache, get_sqlite_cache, file_cache_key
+from .utils import SingleFlight, atomic_open, file_lock, files_fresh, run_in_executor, shard_path
 
-class Identicon(object):
+_flights = SingleFlight()
 
-    def __init__(self, rows=None, cols=None, bg_color=None):
+_MD5_SIZE = 16
 
-        """Generate identicon image.
+
+@functools.lru_cache(maxsize=None)
+def _cell_table(rows, cols):
+    """
+    Precompute the bit of every cell for a grid shape
+
+    Returns:
+        A tuple of (cells, digest_size), each cell is a tuple of
+        (byte index, bit shift, row, col, mirrored col), byte 0 of the
+        digest is skipped
+    """
+    # The original layout, kept for grids up to 15x15 so existing identicons don't change
+    legacy_cells = int(rows * cols / 2 + cols % 2)
+    if rows <= 15 and cols <= 15 and (legacy_cells - 1) // cols < cols:
+        positions = [(n % rows, n // cols) for n in range(legacy_cells)]
+        digest_size = _MD5_SIZE
+    else:
+        # The left half (and the middle column), filled column by column
+        positions = [(n % rows, n // rows) for n in range(rows * ((cols + 1) // 2))]
+        digest_size = 1 + (len(positions) + 7) // 8
+
+    cells = tuple((1 + n // 8, 7 - n % 8, row, col, cols - col - 1)
+                  for n, (row, col) in enumerate(positions))
+    return cells, digest_size
+
+
+class IdenticonRenderer(object):
+
+    def __init__(self, rows=7, cols=7, bg_color=None, fg_color=None, cache=None, cache_timeout=None,
+                 lock_path=None):
+
+        """Render identicon image, with explicit parameters. It doesn't need an application context
+        and can be pickled (with no cache or a :class:`~flask_avatars.cache.SQLiteCache`), so it can be
+        used in batch jobs, thread pools and process pools. In a Flask application, use
+        :class:`Identicon` instead, it reads the parameters from configuration.
 
         :param rows: The row of pixels in avatar.
-        :param columns: The column of pixels in avatar.
+        :param cols: The column of pixels in avatar.
         :param bg_color: Backgroud color, pass RGB tuple, for example: (125, 125, 125).
                Set it to ``None`` to use random color.
+        :param fg_color: Foreground color, pass RGB tuple. Set it to ``None`` to use random color.
+        :param cache: The cache backend for rendered images, default to no cache.
+        :param cache_timeout: Seconds before the cached images expire, ``None`` means never expire.
+        :param lock_path: The directory of lock files to coalesce renders across processes.
         """
 
-        self.rows = rows or current_app.config['AVATARS_IDENTICON_ROWS']
-        self.cols = cols or current_app.config['AVATARS_IDENTICON_COLS']
-        self.bg_colour = bg_color or current_app.config['AVATARS_IDENTICON_BG']
+        self.rows = rows
+        self.cols = cols
+        self.bg_colour = bg_color
+        self.fg_colour = fg_color
         self._generate_colours()
 
-        m = hashlib.md5()
-        m.update(b"hello world")
-        entropy = len(m.hexdigest()) / 2 * 8
-        if self.rows > 15 or self.cols > 15:
-            raise ValueError("Rows and columns must be valued 15 or under")
+        self.cache = cache
+        self.cache_timeout = cache_timeout
+        self.lock_path = lock_path
+
+        if self.rows < 1 or self.cols < 1:
+            raise ValueError("Rows and columns must be valued 1 or above")
 
-        self.digest = hashlib.md5
-        self.digest_entropy = entropy
+        self._cells, self._digest_size = _cell_table(self.rows, self.cols)
+        self.digest_entropy = self._digest_size * 8
 
     def _generate_colours(self):
+        fg_colour = self.fg_colour
         colours_ok = False
 
         while colours_ok is False:
-            self.fg_colour = self._get_pastel_colour()
+            self.fg_colour = fg_colour or self._get_pastel_colour()
 
             if self.bg_colour is None:
                 self.bg_colour = self._get_pastel_colour(lighten=80)
@@ -69,17 +114,61 @@ class Identicon(object):
             else:
                 colours_ok = True
 
-    def get_image(self, string, width, height, pad=0):
+    def get_image(self, string, width, height, pad=0, stream=None, as_memoryview=False):
         """
           Byte representation of a PNG image
+
+          Pass a file-like object as ``stream`` to encode the image directly into it
+          (``None`` will be returned), or set ``as_memoryview`` to ``True`` to get a
+          ``memoryview`` of the encoded image instead of a copy in ``bytes``.
         """
+        if self.cache is not None:
+            key = self._cache_key(string, width, height, pad)
+            image = self.cache.get(key)
+            if image is None:
+                # concurrent misses of the same image were coalesced into one render
+                image = _flights.do(key, self._render_to_cache, key, string, width, height, pad)
+            if stream is not None:
+                stream.write(image)
+                return None
+            return memoryview(image) if as_memoryview else image
+
+        if stream is not None:
+            self._render(string, width, height, pad, stream)
+            return None
+        buffer = BytesIO()
+        self._render(string, width, height, pad, buffer)
+        return buffer.getbuffer() if as_memoryview else buffer.getvalue()
+
+    def _render_to_cache(self, key, string, width, height, pad):
+        with file_lock(self.lock_path, key):
+            if self.lock_path is not None:
+                # may be rendered by another process while waiting for the lock
+                image = self.cache.get(key)
+                if image is not None:
+                    return image
+            buffer = BytesIO()
+            self._render(string, width, height, pad, buffer)
+            image = buffer.getvalue()
+            self.cache.set(key, image, timeout=self.cache_timeout)
+            return image
+
+    def _render(self, string, width, height, pad, stream):
         hex_digest_byte_list = self._string_to_byte_list(string)
         matrix = self._create_matrix(hex_digest_byte_list)
-        return self._create_image(matrix, width, height, pad)
+        self._draw_image(matrix, width, height, pad).save(stream, format="png", optimize=True)
+
+    def _cache_key(self, string, width, height, pad):
+        """
+        Cache key of a rendered image, made of the text digest and all the render parameters
+        """
+        params = (hashlib.sha1(str.encode(string)).hexdigest(), width, height, pad,
+                  self.rows, self.cols, tuple(self.fg_colour), tuple(self.bg_colour))
+        return 'identicon:' + hashlib.sha1(repr(params).encode('utf-8')).hexdigest()
 
     def save(self, image_byte_array=None, save_location=None):
         if image_byte_array and save_location:
-            with open(save_location, 'wb') as f:
+            with atomic_open(save_location) as f:
                 return f.write(image_byte_array)
         else:
             raise ValueError('image_byte_array and path must be provided')
@@ -109,62 +198,53 @@ class Identicon(object):
 
     def _string_to_byte_list(self, data):
         """
-        Creates a hex digest of the input string given to create the image,
-        if it's not already hexadecimal
+        Creates a digest of the input string given to create the image
 
         Returns:
-            Length 16 list of rgb value range integers
-            (each representing a byte of the hex digest)
+            List of rgb value range integers (each representing a byte of the digest),
+            MD5 (16 bytes) for grids up to 15x15, otherwise SHAKE-256 in the length
+            the grid needs
         """
-        bytes_length = 16
+        if self._digest_size == _MD5_SIZE:
+            return list(hashlib.md5(str.encode(data)).digest())
+        return list(hashlib.shake_256(str.encode(data)).digest(self._digest_size))
 
-        m = self.digest()
-        m.update(str.encode(data))
-        hex_digest = m.hexdigest()
-
-        return list(int(hex_digest[num * 2:num * 2 + 2], bytes_length)
-                    for num in range(bytes_length))
-
-    def _bit_is_one(self, n, hash_bytes):
+    def _draw_image(self, matrix, width, height, pad):
         """
-        Check if the n (index) of hash_bytes is 1 or 0.
+        Draws the matrix, returns a palette image with two colours,
+        it encodes to a 1-bit PNG
         """
+        from PIL import Image
 
-        scale = 16  # hexadecimal
+        size = (width + (pad * 2), height + (pad * 2))
+        image = Image.frombytes("P", size, self._index_bytes(matrix, width, height, pad))
+        image.putpalette(tuple(self.bg_colour) + tuple(self.fg_colour))
+        return image
 
-        if not hash_bytes[int(n / (scale / 2))] >> int(
-                (scale / 2) - ((n % (scale / 2)) + 1)) & 1 == 1:
-            return False
-        return True
-
-    def _create_image(self, matrix, width, height, pad):
+    def _index_bytes(self, matrix, width, height, pad):
         """
-        Generates a PNG byte list
+        Rasterizes the matrix into palette indexes (1 for fg_colour), row by row,
+        each block covers the same pixels as a rectangle drawn with ImageDraw
         """
-
-        image = Image.new("RGB", (width + (pad * 2),
-                                  height + (pad * 2)), self.bg_colour)
-        image_draw = ImageDraw.Draw(image)
-
         # Calculate the block width and height.
         block_width = float(width) / self.cols
         block_height = float(height) / self.rows
+        full_width = width + pad * 2
 
-        # Loop through blocks in matrix, draw rectangles.
+        # The pixel span of each column and row, ImageDraw truncates the coordinates
+        col_spans = [(int(pad + col * block_width), int(pad + (col + 1) * block_width - 1))
+                     for col in range(self.cols)]
+        blank = bytes(full_width)
+        lines = [blank] * (height + pad * 2)
         for row, cols in enumerate(matrix):
-            for col, cell in enumerate(cols):
-                if cell:
-                    image_draw.rectangle((
-                        pad + col * block_width,  # x1
-                        pad + row * block_height,  # y1
-                        pad + (col + 1) * block_width - 1,  # x2
-                        pad + (row + 1) * block_height - 1  # y2
-                    ), fill=self.fg_colour)
-
-        stream = BytesIO()
-        image.save(stream, format="png", optimize=True)
-        # return the image byte data
-        return stream.getvalue()
+            line = bytearray(full_width)
+            for (x1, x2), cell in zip(col_spans, cols):
+                if cell and x2 >= x1:
+                    line[x1:x2 + 1] = b"\x01" * (x2 - x1 + 1)
+            y1 = int(pad + row * block_height)
+            y2 = int(pad + (row + 1) * block_height - 1)
+            lines[y1:y2 + 1] = [bytes(line)] * max(0, y2 - y1 + 1)
+        return b"".join(lines)
 
     def _create_matrix(self, byte_list):
         """
@@ -181,41 +261,156 @@ class Identicon(object):
             [True, True, True, True],
             [False, False, False, False]]
         """
-
-        # Number of rows * cols halfed and rounded
-        # in order to fill opposite side
-        cells = int(self.rows * self.cols / 2 + self.cols % 2)
-
         matrix = [[False] * self.cols for num in range(self.rows)]
 
-        for cell_number in range(cells):
-
-            # If the bit with index corresponding to this cell is 1
-            # mark that cell as fg_colour
-            # Skip byte 1, that's used in determining fg_colour
-            if self._bit_is_one(cell_number, byte_list[1:]):
-                # Find cell coordinates in matrix.
-                x_row = cell_number % self.rows
-                y_col = int(cell_number / self.cols)
-                # Set coord True and its opposite side
-                matrix[x_row][self.cols - y_col - 1] = True
-                matrix[x_row][y_col] = True
+        # If the bit of the cell is 1 mark the cell and its opposite side as fg_colour
+        for byte, shift, row, col, mirror_col in self._cells:
+            if byte_list[byte] >> shift & 1:
+                matrix[row][col] = True
+                matrix[row][mirror_col] = True
         return matrix
 
-    def generate(self, text):
+    def generate(self, text, save_path, sizes=(30, 60, 150), shard_depth=0, file_cache=None):
         """Generate and save avatars, return a list of file name: [filename_s, filename_m, filename_l].
 
         :param text: The text used to generate image.
+        :param save_path: The directory to save avatars.
+        :param sizes: The avatar size tuple in a format of ``(small, medium, large)``.
+        :param shard_depth: The levels of shard directories, see ``AVATARS_SHARD_DEPTH``.
+        :param file_cache: The cache backend to store the files for the serving endpoint.
         """
-        sizes = current_app.config['AVATARS_SIZE_TUPLE']
-        path = current_app.config['AVATARS_SAVE_PATH']
-        suffix = {sizes[0]: 's', sizes[1]: 'm', sizes[2]: 'l'}
-
-        for size in sizes:
+        files, paths = self._targets(text, save_path, sizes, shard_depth)
+        # concurrent generations of the same avatar were coalesced
+        _flights.do(('identicon', paths[0]), self._generate, text, files, paths, file_cache)
+        return [filename for size, filename in files]
+
+    def _generate(self, text, files, paths, file_cache, images=None):
+        started = time.time()
+        with file_lock(self.lock_path, ('identicon', paths[0])):
+            # may be generated by another process while waiting for the lock
+            if self.lock_path is not None and files_fresh(paths, started):
+                return
+            self._generate_files(text, files, paths, file_cache, images)
+
+    def _generate_files(self, text, files, paths, file_cache, images=None):
+        """Render and write the files, or write the ``images`` rendered by :meth:`generate_async`."""
+        for index, ((size, filename), path) in enumerate(zip(files, paths)):
+            if images is not None:
+                self.save(images[index], save_location=path)
+                if file_cache is not None:
+                    file_cache.set(file_cache_key(filename), images[index], timeout=self.cache_timeout)
+                continue
+            if file_cache is None:
+                # encode straight to the destination file
+                with atomic_open(path) as f:
+                    self.get_image(str(text), int(size), int(size), int(size * 0.1), stream=f)
+                continue
             image_byte_array = self.get_image(
                 string=str(text),
                 width=int(size),
                 height=int(size),
-                pad=int(size * 0.1))
-            self.save(image_byte_array, save_location=os.path.join(path, '%s_%s.png' % (text, suffix[size])))
-        return [text + '_s.png', text + '_m.png', text + '_l.png']
+                pad=int(size * 0.1),
+                as_memoryview=True)
+            self.save(image_byte_array, save_location=path)
+            file_cache.set(file_cache_key(filename), image_byte_array, timeout=self.cache_timeout)
+
+    async def generate_async(self, text, save_path, sizes=(30, 60, 150), shard_depth=0, file_cache=None,
+                             executor=None):
+        """The awaitable version of :meth:`generate`. The three sizes are rendered concurrently in
+        ``executor``, the files are written in a thread pool, coalesced and locked as :meth:`generate`.
+
+        :param executor: The executor for rendering, default to the event loop's default executor.
+            A process pool needs the renderer to be pickled, so the cache must be ``None`` or a
+            :class:`~flask_avatars.cache.SQLiteCache`, otherwise :exc:`TypeError` will be raised.
+        """
+        import asyncio
+
+        self._check_executor(executor)
+        files, paths = self._targets(text, save_path, sizes, shard_depth)
+
+        images = await asyncio.gather(*(
+            run_in_executor(executor, self.get_image, str(text), int(size), int(size), int(size * 0.1))
+            for size, filename in files))
+        await run_in_executor(None, _flights.do, ('identicon', paths[0]), self._generate, text, files, paths,
+                              file_cache, images)
+        return [filename for size, filename in files]
+
+    def _check_executor(self, executor):
+        """
+        Refuse a process pool before rendering if the cache can't be pickled (e.g. it holds a lock)
+        """
+        from concurrent.futures import ProcessPoolExecutor
+
+        if self.cache is None or not isinstance(executor, ProcessPoolExecutor):
+            return
+        try:
+            pickle.dumps(self.cache)
+        except Exception:
+            raise TypeError('%s can\'t be used in a process pool, use no cache or a SQLiteCache to render '
+                            'identicons in a process pool.' % type(self.cache).__name__)
+
+    def _targets(self, text, save_path, sizes, shard_depth):
+        """
+        Pairs of (size, filename) for the small, medium and large avatar, and their paths
+        """
+        files = [(size, '%s_%s.png' % (text, suffix)) for size, suffix in zip(sizes, 'sml')]
+        paths = [os.path.join(save_path, shard_path(filename, shard_depth)) for size, filename in files]
+        for path in paths:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        return files, paths
+
+
+class Identicon(IdenticonRenderer):
+
+    def __init__(self, rows=None, cols=None, bg_color=None, fg_color=None, cache=None):
+
+        """Generate identicon image, the parameters default to the configuration.
+
+        :param rows: The row of pixels in avatar.
+        :param columns: The column of pixels in avatar.
+        :param bg_color: Backgroud color, pass RGB tuple, for example: (125, 125, 125).
+               Set it to ``None`` to use random color.
+        :param fg_color: Foreground color, pass RGB tuple. Set it to ``None`` to use random color.
+        :param cache: The cache backend for rendered images, default to ``AVATARS_CACHE``,
+               or the SQLite cache at ``AVATARS_IDENTICON_CACHE`` (if set).
+        """
+        config = current_app.config
+        if cache is None:
+            cache = get_cache()
+        if cache is None and config['AVATARS_IDENTICON_CACHE']:
+            cache = get_sqlite_cache(config['AVATARS_IDENTICON_CACHE'], config['AVATARS_IDENTICON_CACHE_SIZE'])
+
+        super(Identicon, self).__init__(
+            rows=rows or config['AVATARS_IDENTICON_ROWS'],
+            cols=cols or config['AVATARS_IDENTICON_COLS'],
+            bg_color=bg_color or config['AVATARS_IDENTICON_BG'],
+            fg_color=fg_color or config['AVATARS_IDENTICON_FG'],
+            cache=cache,
+            cache_timeout=config['AVATARS_CACHE_TIMEOUT'],
+            lock_path=config['AVATARS_LOCK_PATH'])
+
+    def generate(self, text):
+        """Generate and save avatars, return a list of file name: [filename_s, filename_m, filename_l].
+
+        :param text: The text used to generate image.
+        """
+        return super(Identicon, self).generate(text, **self._save_options())
+
+    async def generate_async(self, text):
+        """The awaitable version of :meth:`generate`. The three sizes are rendered concurrently in
+        ``AVATARS_EXECUTOR``, the files are written in a thread pool.
+
+        :param text: The text used to generate image.
+        """
+        return await super(Identicon, self).generate_async(
+            text, executor=current_app.config['AVATARS_EXECUTOR'], **self._save_options())
+
+    @staticmethod
+    def _save_options():
+        config = current_app.config
+        return {
+            'save_path': config['AVATARS_SAVE_PATH'],
+            'sizes': config['AVATARS_SIZE_TUPLE'],
+            'shard_depth': config['AVATARS_SHARD_DEPTH'],
+            'file_cache': get_cache(),
+        }
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_avatars.limiter
+    ~~~~~~~~~~~~~~~~~~~~~
+    Limit the memory used by concurrent image decoding.
+
+    :author: Grey Li <withlihui@gmail.com>
+    :copyright: © 2018 Grey Li
+    :license: MIT, see LICENSE for more details.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+
+class DecodeBudgetExceeded(RuntimeError):
+    """Raised when an image can't be decoded within the memory budget in time."""
+
+
+#: The full-size frame buffers kept while cropping an animation: the decoded frame and its
+#: RGBA copy, see :func:`~flask_avatars.processing.crop_animation`.
+ANIMATION_BUFFERS = 2
+
+
+def estimate_memory(img):
+    """Estimate the decoded size of an image in bytes from its header, no pixel data will be loaded.
+    The frames of an animated image were converted to RGBA, so it's estimated at 4 bands for each
+    of the :data:`ANIMATION_BUFFERS`, whatever the mode of the file (e.g. a ``P`` mode GIF).
+
+    :param img: An image returned by ``Image.open()``.
+    """
+    if getattr(img, 'is_animated', False):
+        return img.size[0] * img.size[1] * 4 * ANIMATION_BUFFERS
+    return img.size[0] * img.size[1] * len(img.getbands())
+
+
+def estimate_file_memory(path):
+    """Estimate the decoded size of the image at ``path``, see :func:`estimate_memory`.
+
+    :param path: The image path.
+    """
+    from PIL import Image
+
+    with Image.open(path) as img:
+        return estimate_memory(img)
+
+
+class DecodeLimiter(object):
+
+    def __init__(self, budget=None, timeout=None):
+        """Admission controller for image work, budgeted by the estimated decoded memory.
+
+        :param budget: The total bytes of decoded images allowed in memory at once,
+               ``None`` means no limit.
+        :param timeout: The seconds to wait for the budget, ``0`` to reject immediately,
+               ``None`` to wait forever.
+        """
+        self.budget = budget
+        self.timeout = timeout
+        self.in_use = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._cond = threading.Condition()
+
+    @property
+    def metrics(self):
+        """A dict of the current memory in use, queue depth, admitted and rejected counts."""
+        with self._cond:
+            return {
+                'budget': self.budget,
+                'in_use': self.in_use,
+                'waiting': self.waiting,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+            }
+
+    def acquire(self, cost):
+        with self._cond:
+            if self.budget is None:
+                self.in_use += cost
+                self.admitted += 1
+                return
+            if cost > self.budget:
+                self.rejected += 1
+                raise DecodeBudgetExceeded('Image needs %d bytes, more than the budget (%d bytes).'
+                                           % (cost, self.budget))
+            deadline = None if self.timeout is None else time.monotonic() + self.timeout
+            self.waiting += 1
+            try:
+                while self.in_use + cost > self.budget:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        self.rejected += 1
+                        raise DecodeBudgetExceeded('Timed out waiting for %d bytes of decode budget.' % cost)
+                    self._cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.in_use += cost
+            self.admitted += 1
+
+    def release(self, cost):
+        with self._cond:
+            self.in_use -= cost
+            self._cond.notify_all()
+
+    @contextmanager
+    def limit(self, cost):
+        """Wait until ``cost`` bytes fit in the budget, hold them in the ``with`` block.
+
+        :param cost: The estimated bytes, see :func:`estimate_memory`.
+        """
+        self.acquire(cost)
+        try:
+            yield
+        finally:
+            self.release(cost)
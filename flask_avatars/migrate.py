@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_avatars.migrate
+    ~~~~~~~~~~~~~~~~~~~~~
+    Re-encode the saved avatar files in bulk, or regenerate the ``_s`` and ``_m``
+    files after ``AVATARS_SIZE_TUPLE`` changed.
+
+    :author: Grey Li <withlihui@gmail.com>
+    :copyright: © 2018 Grey Li
+    :license: MIT, see LICENSE for more details.
+"""
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from io import BytesIO
+
+from .utils import VARIANT_RE, atomic_open, iter_avatar_files
+
+#: The default journal file name, in the save path.
+JOURNAL_NAME = '.avatars-migrate.journal'
+
+
+class MigrationReport(object):
+
+    def __init__(self):
+        """The result of :func:`migrate`."""
+        #: The files rewritten.
+        self.migrated = 0
+        #: The files kept as is, the new encoding isn't smaller or the file changed meanwhile.
+        self.skipped = 0
+        #: The files failed to migrate or verify, they were kept as is.
+        self.failed = 0
+        self.bytes_before = 0
+        self.bytes_after = 0
+        self.elapsed = 0.0
+        #: A list of ``(relpath, error)`` tuples of the failed files.
+        self.errors = []
+
+    @property
+    def files(self):
+        return self.migrated + self.skipped + self.failed
+
+    @property
+    def bytes_saved(self):
+        return self.bytes_before - self.bytes_after
+
+    @property
+    def throughput(self):
+        """Files per second."""
+        return self.files / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        return ('%d file(s) in %.1fs (%.1f files/s): %d migrated, %d skipped, %d failed, '
+                '%d bytes saved (%d -> %d).' % (
+                    self.files, self.elapsed, self.throughput, self.migrated, self.skipped, self.failed,
+                    self.bytes_saved, self.bytes_before, self.bytes_after))
+
+
+def _encode(img, compress_level, optimize):
+    stream = BytesIO()
+    img.save(stream, format='png', compress_level=compress_level, optimize=optimize)
+    return stream.getvalue()
+
+
+def _verify(data, expected, lossless):
+    """Decode the encoded ``data`` and check it against the ``expected`` image."""
+    from PIL import Image, ImageChops
+
+    with Image.open(BytesIO(data)) as output:
+        output.load()
+        if output.size != expected.size:
+            return False
+        if not lossless:
+            return True
+        mode = 'RGBA' if 'A' in expected.getbands() or 'transparency' in expected.info else 'RGB'
+        return ImageChops.difference(expected.convert(mode), output.convert(mode)).getbbox() is None
+
+
+def _candidates(img, compress_level, optimize):
+    """Yield the encodings of ``img``: as is, and as a palette image if it has 256 colours or less."""
+    from PIL import Image
+
+    yield _encode(img, compress_level, optimize)
+    colors = img.getcolors(256) if img.mode in ('RGB', 'RGBA', 'L') else None
+    if colors is not None:
+        method = Image.FASTOCTREE if img.mode == 'RGBA' else Image.MEDIANCUT
+        yield _encode(img.convert('RGB' if img.mode == 'L' else img.mode).quantize(len(colors), method),
+                      compress_level, optimize)
+
+
+def _identicon_width(size):
+    """The width of an identicon of ``size``, with the padding on both sides."""
+    return size + int(size * 0.1) * 2
+
+
+def _target_width(large, size, large_size):
+    """Return the width of a ``size`` variant of the ``large`` (``_l``) image. Identicons have a
+    padding, cropped avatars don't, they're told apart by the width of the ``_l`` file.
+    """
+    if large.size[0] == large_size:
+        return size
+    if large.size[0] == _identicon_width(large_size):
+        return _identicon_width(size)
+    raise ValueError('The _l file is %dpx wide, not %dpx (or %dpx with the identicon padding), it '
+                     "can't be resized from itself, crop or generate the avatar again."
+                     % (large.size[0], large_size, _identicon_width(large_size)))
+
+
+def migrate_file(path, source=None, size=None, large_size=None, compress_level=9, optimize=True):
+    """Re-encode an avatar file, resize it from ``source`` first if ``size`` is given. The output
+    is decoded and verified (same size, and same pixels unless resized) before it's renamed into
+    place, a re-encoded file is only written if it's smaller. Return a tuple of
+    ``(status, bytes_before, bytes_after)``, status is ``'migrated'`` or ``'skipped'``.
+
+    It's a pure function, so it can run in a process pool.
+
+    :param path: The path of the avatar file.
+    :param source: The path of the ``_l`` file to resize from.
+    :param size: The new size of the output.
+    :param large_size: The new size of the ``_l`` file. If it's given, :exc:`ValueError` will be
+        raised when the ``_l`` file (``source``, or ``path`` itself without ``source``) isn't
+        this size, the large variants can only be cropped or generated again.
+    :param compress_level: The zlib compression level, 0-9.
+    :param optimize: Let the PNG encoder spend more time to make the file smaller.
+    """
+    from PIL import Image
+
+    stat = os.stat(path)
+    data = None
+    with Image.open(path) as img:
+        img.load()
+        if large_size is not None and source is None:
+            _target_width(img, large_size, large_size)
+        if source is not None and size is not None:
+            with Image.open(source) as src:
+                width = _target_width(src, size, large_size) if large_size is not None else size
+                if width != img.size[0]:
+                    src = src.convert('RGBA' if 'A' in src.getbands() or 'transparency' in src.info else 'RGB')
+                    height = max(1, int(round(src.size[1] * width / float(src.size[0]))))
+                    resized = src.resize((width, height), Image.BICUBIC)
+                    data = _encode(resized, compress_level, optimize)
+                    if not _verify(data, resized, lossless=False):
+                        raise ValueError('The output did not pass the verification.')
+        if data is None:
+            # the smallest lossless encoding, or keep the file
+            for candidate in sorted(_candidates(img, compress_level, optimize), key=len):
+                if len(candidate) >= stat.st_size:
+                    return 'skipped', stat.st_size, stat.st_size
+                if _verify(candidate, img, lossless=True):
+                    data = candidate
+                    break
+            else:
+                return 'skipped', stat.st_size, stat.st_size
+
+    # the file was rewritten (e.g. cropped again) since it was read
+    if os.stat(path).st_mtime_ns != stat.st_mtime_ns:
+        return 'skipped', stat.st_size, stat.st_size
+    with atomic_open(path) as f:
+        f.write(data)
+    return 'migrated', stat.st_size, len(data)
+
+
+def _run_task(task):
+    relpath, args = task
+    try:
+        return relpath, migrate_file(*args), None
+    except Exception as e:
+        return relpath, None, '%s: %s' % (type(e).__name__, e)
+
+
+def _load_journal(journal):
+    done = set()
+    if journal is not None and os.path.exists(journal):
+        with open(journal, encoding='utf-8') as f:
+            for line in f:
+                relpath, _, status = line.rstrip('\n').rpartition('\t')
+                if status != 'failed':
+                    done.add(relpath)
+    return done
+
+
+def iter_tasks(save_path, sizes=None, compress_level=9, optimize=True, done=()):
+    """Scan the save path and yield a ``(relpath, args)`` task of :func:`migrate_file` for every
+    avatar variant not in ``done``.
+
+    :param save_path: The save path.
+    :param sizes: The new ``(small, medium, large)`` sizes, to regenerate the ``_s`` and ``_m``
+        files from the ``_l`` file, and check the ``_l`` files. ``None`` means only re-encode.
+    :param compress_level: The zlib compression level, 0-9.
+    :param optimize: Let the PNG encoder spend more time to make the files smaller.
+    :param done: The relative paths to skip.
+    """
+    for entry in iter_avatar_files(save_path):
+        match = VARIANT_RE.match(entry.name)
+        if match is None or match.group('ext') != 'png':  # animated avatars are kept as is
+            continue
+        relpath = os.path.relpath(entry.path, save_path)
+        if relpath in done:
+            continue
+        source = size = large_size = None
+        if sizes is not None and match.group('size') in ('s', 'm', 'l'):
+            large_size = sizes[2]
+            if match.group('size') != 'l':
+                source = os.path.join(os.path.dirname(entry.path), match.group('name') + '_l.png')
+                if os.path.exists(source):
+                    size = sizes['sml'.index(match.group('size'))]
+                else:
+                    source = large_size = None
+        yield relpath, (entry.path, source, size, large_size, compress_level, optimize)
+
+
+def migrate(save_path, sizes=None, compress_level=9, optimize=True, journal=None, workers=None,
+            restart=False, callback=None):
+    """Migrate all the avatar variants in ``save_path`` over a process pool, return a
+    :class:`MigrationReport`.
+
+    The scan is streaming and only a few tasks per worker are in flight. Every finished file is
+    appended to ``journal``, run it again with the same journal to resume an interrupted migration
+    (the failed files will be retried). The relative paths of the finished files were loaded into
+    a set to resume, so the memory usage grows with the journal, not with the files to migrate.
+
+    :param save_path: The save path, ``AVATARS_SAVE_PATH``.
+    :param sizes: The new ``(small, medium, large)`` sizes to regenerate the ``_s`` and ``_m`` files,
+        they were resized from the ``_l`` file to these sizes (with the padding of identicons). The
+        ``_l`` file is the master, it's only re-encoded, if the large size changed, the ``_l``, ``_s``
+        and ``_m`` files fail (see :func:`migrate_file`). ``None`` means only re-encode.
+    :param compress_level: The zlib compression level, 0-9.
+    :param optimize: Let the PNG encoder spend more time to make the files smaller.
+    :param journal: The journal file path, default to :data:`JOURNAL_NAME` in the save path,
+        ``False`` to disable.
+    :param workers: The number of worker processes, default to the number of CPUs, ``0`` to
+        run in this process.
+    :param restart: Ignore the journal and start over.
+    :param callback: Called with ``(relpath, status)`` after each file.
+    """
+    if journal is None:
+        journal = os.path.join(save_path, JOURNAL_NAME)
+    elif journal is False:
+        journal = None
+    if restart and journal is not None and os.path.exists(journal):
+        os.remove(journal)
+    tasks = iter_tasks(save_path, sizes=sizes, done=_load_journal(journal),
+                       compress_level=compress_level, optimize=optimize)
+
+    report = MigrationReport()
+    started = time.monotonic()
+    journal_file = open(journal, 'a', buffering=1, encoding='utf-8') if journal is not None else None
+    try:
+        def finish(relpath, result, error):
+            if error is not None:
+                status = 'failed'
+                report.failed += 1
+                report.errors.append((relpath, error))
+            else:
+                status, before, after = result
+                setattr(report, status, getattr(report, status) + 1)
+                report.bytes_before += before
+                report.bytes_after += after
+            if journal_file is not None:
+                journal_file.write('%s\t%s\n' % (relpath, status))
+            if callback is not None:
+                callback(relpath, status)
+
+        if workers == 0:
+            for task in tasks:
+                finish(*_run_task(task))
+        else:
+            workers = workers or os.cpu_count() or 1
+            with ProcessPoolExecutor(workers) as executor:
+                limit = workers * 4
+                pending = set()
+                for task in tasks:
+                    pending.add(executor.submit(_run_task, task))
+                    if len(pending) >= limit:
+                        finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in finished:
+                            finish(*future.result())
+                for future in wait(pending)[0]:
+                    finish(*future.result())
+    finally:
+        if journal_file is not None:
+            journal_file.close()
+        report.elapsed = time.monotonic() - started
+    return report
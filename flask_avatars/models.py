@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_avatars.models
+    ~~~~~~~~~~~~~~~~~~~~
+    Store the Gravatar hash in the user model, so pages don't hash the emails
+    on every request.
+
+    :author: Grey Li <withlihui@gmail.com>
+    :copyright: © 2018 Grey Li
+    :license: MIT, see LICENSE for more details.
+"""
+import hashlib
+
+
+def gravatar_hash(email):
+    """Return the Gravatar hash of an email, ``None`` if the email is empty.
+
+    :param email: The email address.
+    """
+    if not email:
+        return None
+    return hashlib.md5(email.strip().lower().encode('utf-8')).hexdigest()
+
+
+class GravatarMixin(object):
+    """Compute the Gravatar hash when the email was set and store it in another attribute.
+    Works with plain classes and ORM models (SQLAlchemy, Peewee, etc.), add a column for the
+    hash, it will be saved with the email::
+
+        class User(db.Model, GravatarMixin):
+            email = db.Column(db.String(254))
+            email_hash = db.Column(db.String(32))
+
+        user = User(email='Grey@HelloFlask.com')
+        user.email_hash  # '...'
+
+    The hash was only computed when the email was assigned, not when the object was loaded
+    from the database, use :func:`backfill_gravatar_hashes` for the existing rows.
+    """
+
+    #: The attribute of the email.
+    gravatar_email_attr = 'email'
+    #: The attribute to store the hash.
+    gravatar_hash_attr = 'email_hash'
+
+    def __setattr__(self, name, value):
+        super(GravatarMixin, self).__setattr__(name, value)
+        if name == self.gravatar_email_attr:
+            super(GravatarMixin, self).__setattr__(self.gravatar_hash_attr, gravatar_hash(value))
+
+    def gravatar_url(self, size=100, **kwargs):
+        """Return the Gravatar URL with the stored hash, see :meth:`~flask_avatars._Avatars.gravatar`.
+
+        :param size: The size of the avatar, default to 100 pixel.
+        """
+        from . import _Avatars
+
+        email_hash = getattr(self, self.gravatar_hash_attr, None)
+        if email_hash is None:
+            email_hash = gravatar_hash(getattr(self, self.gravatar_email_attr, None)) or ''
+        return _Avatars.gravatar(email_hash, size=size, **kwargs)
+
+
+def backfill_gravatar_hashes(rows, commit=None, chunk_size=1000, email_attr='email', hash_attr='email_hash'):
+    """Compute the missing or stale Gravatar hashes of the existing rows in chunks, return the
+    number of updated rows.
+
+    :param rows: An iterable of the rows, or a callable takes ``chunk_size`` and returns the next chunk
+        of rows to check. With an ORM, the callable form re-queries after each commit, for example
+        ``lambda n: User.query.filter(User.email_hash.is_(None), User.email.isnot(None)).limit(n).all()``.
+        The backfill stops when a chunk is empty or has nothing to update.
+    :param commit: Called after each chunk, e.g. ``db.session.commit``.
+    :param chunk_size: The number of rows in a chunk.
+    :param email_attr: The attribute of the email.
+    :param hash_attr: The attribute to store the hash.
+    """
+    def update(chunk):
+        count = 0
+        for row in chunk:
+            value = gravatar_hash(getattr(row, email_attr, None))
+            if getattr(row, hash_attr, None) != value:
+                setattr(row, hash_attr, value)
+                count += 1
+        if commit is not None:
+            commit()
+        return count
+
+    updated = 0
+    if callable(rows):
+        while True:
+            chunk = list(rows(chunk_size))
+            count = update(chunk) if chunk else 0
+            if not count:
+                return updated
+            updated += count
+
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            updated += update(chunk)
+            chunk = []
+    if chunk:
+        updated += update(chunk)
+    return updated
@@ -0,0 +1,417 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_avatars.processing
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+    Image processing functions. They don't need an application context and can be
+    pickled, so they can run in a thread or process pool.
+
+    :author: Grey Li <withlihui@gmail.com>
+    :copyright: © 2018 Grey Li
+    :license: MIT, see LICENSE for more details.
+"""
+from contextlib import nullcontext
+from io import BytesIO
+
+from .limiter import estimate_memory
+from .utils import atomic_open
+
+
+class InvalidCropError(ValueError):
+    """Raised when the crop box is invalid or outside of the image, turn it into a 400 response."""
+
+
+def resize_image(img, base_width):
+    """Resize an image to ``base_width``, keep the aspect ratio.
+
+    :param img: The image that needs to be resize.
+    :param base_width: The width of output image.
+    """
+    from PIL import Image
+
+    w_percent = (base_width / float(img.size[0]))
+    h_size = int((float(img.size[1]) * float(w_percent)))
+    return img.resize((base_width, h_size), Image.BICUBIC)
+
+
+def parse_box(x, y, w, h):
+    """Convert the crop parameters (generally strings from the form) to a box of ints.
+
+    :param x: The x-pos to start crop.
+    :param y: The y-pos to start crop.
+    :param w: The crop width.
+    :param h: The crop height.
+    """
+    try:
+        box = tuple(int(float(value)) for value in (x, y, w, h))
+    except (TypeError, ValueError, OverflowError):
+        raise InvalidCropError('The crop box must be numbers, got %r.' % ((x, y, w, h),))
+    if box[2] <= 0 or box[3] <= 0:
+        raise InvalidCropError('The crop width and height must be positive, got %r.' % (box,))
+    return box
+
+
+def clamp_box(img, box, base_width):
+    """Clamp the crop box to the image scaled to ``base_width`` (what :func:`crop_image` crops),
+    the size was read from the header, no pixel data will be loaded. A square box stays square.
+    Raise :exc:`InvalidCropError` if the box is outside of the image.
+
+    :param img: An image returned by ``Image.open()``.
+    :param box: The crop box, a tuple of ``(x, y, w, h)``.
+    :param base_width: The width of the crop box in page, ``AVATARS_CROP_BASE_WIDTH``.
+    """
+    width, height = upright_size(img)
+    if width >= base_width:
+        width, height = base_width, int(height * (base_width / float(width)))
+    x, y, w, h = box
+    if x >= width or y >= height or x + w <= 0 or y + h <= 0:
+        raise InvalidCropError('The crop box %r is outside of the image (%dx%d).' % (box, width, height))
+    left, top = max(0, x), max(0, y)
+    right, bottom = min(width, x + w), min(height, y + h)
+    if w == h:
+        side = min(right - left, bottom - top)
+        right, bottom = left + side, top + side
+    return left, top, right - left, bottom - top
+
+
+def crop_image(img, box, base_width):
+    """Scale the image down to ``base_width`` (the width of crop box) if it's wider, then crop it.
+
+    The EXIF orientation was applied, the box is in the upright image (as the browser shows it),
+    but only the cropped area was transposed. The metadata was stripped, see :func:`strip_metadata`.
+
+    :param img: The raw image.
+    :param box: The crop box, a tuple of ``(x, y, w, h)``.
+    :param base_width: The width of the crop box in page, ``AVATARS_CROP_BASE_WIDTH``.
+    """
+    from PIL import Image
+
+    x, y, w, h = box
+    method = _ORIENTATIONS.get(exif_orientation(img))
+    if method in _SWAPPED:
+        size = upright_size(img)
+        if size[0] >= base_width:
+            height = int(size[1] * (base_width / float(size[0])))
+            img = img.resize((height, base_width), Image.BICUBIC)
+    elif img.size[0] >= base_width:
+        img = resize_image(img, base_width)
+
+    if method is None:
+        cropped = img.crop((x, y, x + w, y + h))
+    else:
+        cropped = img.crop(_source_box((x, y, x + w, y + h), img.size, method)).transpose(method)
+    return strip_metadata(cropped)
+
+
+# The transpose method of each EXIF orientation, in the values of ``PIL.Image.Transpose``
+# (FLIP_LEFT_RIGHT, FLIP_TOP_BOTTOM, ROTATE_90, ROTATE_180, ROTATE_270, TRANSPOSE, TRANSVERSE),
+# the same as ``ImageOps.exif_transpose()``.
+_ORIENTATIONS = {2: 0, 3: 3, 4: 1, 5: 5, 6: 4, 7: 6, 8: 2}
+# The methods swap the width and height.
+_SWAPPED = (2, 4, 5, 6)
+
+
+def exif_orientation(img):
+    """Return the EXIF orientation of the image (``1`` means upright), read from the header.
+
+    :param img: An image returned by ``Image.open()``.
+    """
+    try:
+        return img.getexif().get(0x0112, 1)
+    except Exception:  # broken EXIF, ignore it like the browsers do
+        return 1
+
+
+def upright_size(img):
+    """Return the size of the image after the EXIF orientation was applied.
+
+    :param img: An image returned by ``Image.open()``.
+    """
+    if _ORIENTATIONS.get(exif_orientation(img)) in _SWAPPED:
+        return img.size[1], img.size[0]
+    return img.size
+
+
+def _source_box(box, size, method):
+    """Map a box in the transposed image back to the image of ``size`` before ``method``."""
+    left, top, right, bottom = box
+    width, height = size
+    if method in _SWAPPED:
+        width, height = height, width  # the transposed size
+    # the inverse of each method, applied to a point of the transposed image
+    inverse = {
+        0: lambda x, y: (width - x, y),
+        1: lambda x, y: (x, height - y),
+        2: lambda x, y: (height - y, x),
+        3: lambda x, y: (width - x, height - y),
+        4: lambda x, y: (y, width - x),
+        5: lambda x, y: (y, x),
+        6: lambda x, y: (height - y, width - x),
+    }[method]
+    (x1, y1), (x2, y2) = inverse(left, top), inverse(right, bottom)
+    return min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)
+
+
+def strip_metadata(img):
+    """Drop the EXIF, ICC profile and other metadata of the image, so they won't be saved with it.
+    The colors were converted to sRGB first if the image has an ICC profile.
+
+    :param img: The image, it will be modified.
+    """
+    icc = img.info.get('icc_profile')
+    if icc and img.mode in ('RGB', 'RGBA'):
+        try:
+            from PIL import ImageCms
+
+            img = ImageCms.profileToProfile(img, ImageCms.ImageCmsProfile(BytesIO(icc)),
+                                            ImageCms.createProfile('sRGB'), outputMode=img.mode)
+        except Exception:  # no littlecms or a broken profile, keep the colors as is
+            pass
+    img.info = {key: value for key, value in img.info.items() if key == 'transparency'}
+    return img
+
+
+def crop_file(path, box, base_width):
+    """Open the image at ``path`` and crop it, see :func:`crop_image`.
+
+    :param path: The path of the raw image.
+    :param box: The crop box, a tuple of ``(x, y, w, h)``.
+    :param base_width: The width of the crop box in page, ``AVATARS_CROP_BASE_WIDTH``.
+    """
+    from PIL import Image
+
+    with Image.open(path) as img:
+        return crop_image(img, box, base_width)
+
+
+def is_animated(img):
+    """Check if the image is animated and animated WebP can be written, read from the header.
+
+    :param img: An image returned by ``Image.open()``.
+    """
+    from PIL import features
+
+    return getattr(img, 'is_animated', False) and features.check_module('webp')
+
+
+def inspect_file(path, box, base_width):
+    """Read the header of the raw image at ``path`` once, return a tuple of ``(animated, box, cost)``:
+    whether it's animated (see :func:`is_animated`), the clamped crop box (see :func:`clamp_box`)
+    and the estimated decoded size (see :func:`~flask_avatars.limiter.estimate_memory`).
+
+    :param path: The path of the raw image.
+    :param box: The crop box, a tuple of ``(x, y, w, h)``.
+    :param base_width: The width of the crop box in page, ``AVATARS_CROP_BASE_WIDTH``.
+    """
+    from PIL import Image
+
+    with Image.open(path) as img:
+        box = clamp_box(img, box, base_width)
+        return is_animated(img), box, estimate_memory(img)
+
+
+def crop_animation(img, box, base_width, sizes, max_frames=None, max_duration=None, max_pixels=None):
+    """Crop every frame of an animated image then resize them, return a list of animated WebP bytes,
+    one for each size.
+
+    The frames were decoded one at a time, only the small resized frames were kept, so the memory
+    usage doesn't depend on the length of the animation. The animation was cut at the first frame
+    that exceeds a limit (the first frame is always kept).
+
+    :param img: The raw image, an animated GIF or WebP.
+    :param box: The crop box, a tuple of ``(x, y, w, h)``.
+    :param base_width: The width of the crop box in page, ``AVATARS_CROP_BASE_WIDTH``.
+    :param sizes: The output sizes.
+    :param max_frames: The max number of frames, ``None`` means no limit.
+    :param max_duration: The max total duration in milliseconds, ``None`` means no limit.
+    :param max_pixels: The max total pixels of decoded frames, ``None`` means no limit.
+    """
+    from PIL import ImageSequence
+
+    frames = [[] for size in sizes]
+    durations = []
+    total_duration = total_pixels = 0
+    for index, frame in enumerate(ImageSequence.Iterator(img)):
+        duration = frame.info.get('duration') or 100
+        total_duration += duration
+        total_pixels += frame.size[0] * frame.size[1]
+        if index and ((max_frames and index >= max_frames)
+                      or (max_duration and total_duration > max_duration)
+                      or (max_pixels and total_pixels > max_pixels)):
+            break
+        cropped = crop_image(frame.convert('RGBA'), box, base_width)
+        for resized, size in zip(frames, sizes):
+            resized.append(resize_image(cropped, size))
+        durations.append(duration)
+
+    outputs = []
+    for resized in frames:
+        stream = BytesIO()
+        resized[0].save(stream, format='webp', save_all=True, append_images=resized[1:], duration=durations,
+                        loop=img.info.get('loop', 0), quality=80)
+        outputs.append(stream.getvalue())
+    return outputs
+
+
+def crop_animation_file(path, box, base_width, sizes, max_frames=None, max_duration=None, max_pixels=None):
+    """Open the image at ``path`` and crop the animation, see :func:`crop_animation`.
+
+    :param path: The path of the raw image.
+    """
+    from PIL import Image
+
+    with Image.open(path) as img:
+        return crop_animation(img, box, base_width, sizes, max_frames, max_duration, max_pixels)
+
+
+def encode_png(img):
+    """Encode the image as PNG, return the bytes.
+
+    :param img: The image to encode.
+    """
+    stream = BytesIO()
+    img.save(stream, format='png', optimize=True, quality=85)
+    return stream.getvalue()
+
+
+def resize_and_encode(img, base_width):
+    """Resize the image then encode it as PNG, return the bytes.
+
+    :param img: The image to encode.
+    :param base_width: The width of output image.
+    """
+    return encode_png(resize_image(img, base_width))
+
+
+def write_file(path, data):
+    """Write the bytes to ``path`` atomically.
+
+    :param path: The file path.
+    :param data: The bytes to write.
+    """
+    with atomic_open(path) as f:
+        f.write(data)
+
+
+def save_upload(image, path):
+    """Save an uploaded file or an image to ``path`` atomically.
+
+    :param image: A ``FileStorage`` (or any object with a ``save()`` method accepts a file, saved
+        as is) or a PIL image (saved as PNG, upright, without metadata).
+    :param path: The file path.
+    """
+    with atomic_open(path) as f:
+        if hasattr(image, 'getbands'):
+            if exif_orientation(image) != 1:
+                from PIL import ImageOps
+
+                image = ImageOps.exif_transpose(image)
+            strip_metadata(image.copy() if image.info else image).save(f, format='png')
+        else:
+            image.save(f)
+
+
+#: The longer side of the thumbnails compared by :func:`same_image`.
+THUMBNAIL_SIZE = 32
+#: The max difference of any channel of any pixel of the thumbnails of two duplicates.
+PIXEL_TOLERANCE = 16
+
+
+def thumbnail(img):
+    """Return the upright RGB thumbnail of the image, the longer side is :data:`THUMBNAIL_SIZE`.
+
+    :param img: The image.
+    """
+    from PIL import Image
+
+    method = _ORIENTATIONS.get(exif_orientation(img))
+    width, height = upright_size(img)
+    if width >= height:
+        size = THUMBNAIL_SIZE, max(1, int(round(THUMBNAIL_SIZE * height / float(width))))
+    else:
+        size = max(1, int(round(THUMBNAIL_SIZE * width / float(height)))), THUMBNAIL_SIZE
+    if method in _SWAPPED:
+        size = size[::-1]
+    if img.mode not in ('L', 'RGB', 'RGBA'):
+        img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+    small = img.resize(size, Image.BOX).convert('RGB')
+    if method is not None:
+        small = small.transpose(method)
+    return small
+
+
+def fingerprint(thumb):
+    """Return a tuple of the 64-bit difference hash (dHash) and the average color of a
+    :func:`thumbnail`. Similar images have hashes with a small Hamming distance, each bit
+    of the hash is whether a pixel of the 9x8 reduced image is brighter than its right
+    neighbour. The hash ignores colors, so the average color (``0xRRGGBB``) tells a red
+    image from a blue one. It only finds the candidates, check them with :func:`same_image`.
+
+    :param thumb: The thumbnail of the image.
+    """
+    from PIL import Image, ImageChops
+
+    red, green, blue = thumb.resize((1, 1), Image.BOX).getpixel((0, 0))
+    gray = thumb.resize((9, 8), Image.BOX).convert('L')
+    # compare the columns all at once, the 8x8 bits were packed one row per byte
+    diff = ImageChops.subtract(gray.crop((0, 0, 8, 8)), gray.crop((1, 0, 9, 8)))
+    bits = diff.point(lambda value: 255 if value else 0).convert('1', dither=0)
+    return int.from_bytes(bits.tobytes(), 'big'), red << 16 | green << 8 | blue
+
+
+def same_image(a, b):
+    """Check if two thumbnails are of the same image: same size, and no channel of any pixel
+    differs more than :data:`PIXEL_TOLERANCE`, so re-encoded or resized copies match but a
+    changed letter or detail doesn't.
+
+    :param a: A thumbnail.
+    :param b: Another thumbnail.
+    """
+    from PIL import ImageChops
+
+    if a.size != b.size:
+        return False
+    return max(high for low, high in ImageChops.difference(a, b).getextrema()) <= PIXEL_TOLERANCE
+
+
+def _limit(limiter, img):
+    if limiter is None:
+        return nullcontext()
+    return limiter.limit(estimate_memory(img))
+
+
+def open_thumbnail(fp, limiter=None):
+    """Open an image file and return its :func:`thumbnail`, it was decoded at a reduced scale
+    when possible (JPEG).
+
+    :param fp: A file path or a file object.
+    :param limiter: A :class:`~flask_avatars.limiter.DecodeLimiter` to admit the decoding.
+    """
+    from PIL import Image
+
+    with Image.open(fp) as img:
+        img.draft('RGB', (THUMBNAIL_SIZE * 2, THUMBNAIL_SIZE * 2))
+        with _limit(limiter, img):
+            return thumbnail(img)
+
+
+def upload_thumbnail(image, limiter=None):
+    """Return the :func:`thumbnail` of an uploaded file or an image, ``None`` if it can't be
+    decoded (or not within the decode budget). The file was rewound afterwards.
+
+    :param image: A ``FileStorage`` (or a file object) or a PIL image.
+    :param limiter: A :class:`~flask_avatars.limiter.DecodeLimiter` to admit the decoding.
+    """
+    try:
+        if hasattr(image, 'getbands'):
+            with _limit(limiter, image):
+                return thumbnail(image)
+        stream = getattr(image, 'stream', image)
+        if not stream.seekable():
+            return None
+        position = stream.tell()
+        try:
+            return open_thumbnail(stream, limiter)
+        finally:
+            stream.seek(position)
+    except Exception:  # not an image or over the budget, save it as is
+        return None
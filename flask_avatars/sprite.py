@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_avatars.sprite
+    ~~~~~~~~~~~~~~~~~~~~
+    Pack small avatars into one sprite image.
+
+    :author: Grey Li <withlihui@gmail.com>
+    :copyright: © 2018 Grey Li
+    :license: MIT, see LICENSE for more details.
+"""
+import hashlib
+import json
+import math
+import os
+
+from flask import current_app
+
+from .utils import SingleFlight, atomic_open, file_lock, get_avatar_path
+
+_flights = SingleFlight()
+
+
+def sprite_class(filename):
+    """Return the CSS class of an avatar in the sprite.
+
+    :param filename: The avatar's file name.
+    """
+    return 'avatars-sprite-' + hashlib.md5(filename.encode('utf-8')).hexdigest()[:8]
+
+
+def make_sprite(filenames, size=None):
+    """Pack the avatar files into a sprite image, return the sprite's file name and a dict
+    that maps each file name to its ``(x, y)`` position in the sprite.
+
+    The sprite was cached in ``AVATARS_SAVE_PATH`` by the hash of the file name set (and the
+    modification time and size of each file), so the same set of avatars will only be packed
+    once, and packed again when any of them changed. The missing files were skipped, they
+    are not in the dict.
+
+    :param filenames: The file names of the avatars, e.g. identicons or cropped ``_s`` files.
+    :param size: The size of each avatar in sprite, default to ``AVATARS_SIZE_TUPLE[0]``.
+    """
+    size = int(size or current_app.config['AVATARS_SIZE_TUPLE'][0])
+    stats = []
+    for filename in sorted(set(filenames)):
+        try:
+            stat = os.stat(get_avatar_path(filename))
+        except FileNotFoundError:
+            continue
+        stats.append('%s:%d:%d' % (filename, stat.st_mtime_ns, stat.st_size))
+    filenames = [line.rsplit(':', 2)[0] for line in stats]
+    key = hashlib.md5(('%d:' % size + '\n'.join(stats)).encode('utf-8')).hexdigest()
+    sprite_filename = key + '_sprite.png'
+    map_path = get_avatar_path(key + '_sprite.json')
+
+    if os.path.exists(map_path):
+        return sprite_filename, _load_map(map_path)
+    # concurrent requests for the same sprite were coalesced
+    return _flights.do(map_path, _build_sprite, filenames, size, sprite_filename, map_path,
+                       current_app.config['AVATARS_LOCK_PATH'])
+
+
+def _load_map(map_path):
+    with open(map_path) as f:
+        return dict((k, tuple(v)) for k, v in json.load(f).items())
+
+
+def _build_sprite(filenames, size, sprite_filename, map_path, lock_path):
+    with file_lock(lock_path, map_path):
+        # may be built by another process while waiting for the lock
+        if lock_path is not None and os.path.exists(map_path):
+            return sprite_filename, _load_map(map_path)
+        return _pack_sprite(filenames, size, sprite_filename, map_path)
+
+
+def _pack_sprite(filenames, size, sprite_filename, map_path):
+    from PIL import Image
+
+    cols = max(1, int(math.ceil(math.sqrt(len(filenames)))))
+    rows = max(1, int(math.ceil(len(filenames) / float(cols))))
+    sprite = Image.new('RGBA', (cols * size, rows * size), (0, 0, 0, 0))
+
+    positions = {}
+    for index, filename in enumerate(filenames):
+        position = ((index % cols) * size, (index // cols) * size)
+        try:
+            with Image.open(get_avatar_path(filename)) as img:
+                img = img.convert('RGBA')
+                if img.size != (size, size):
+                    img = img.resize((size, size), Image.BICUBIC)
+                sprite.paste(img, position)
+        except FileNotFoundError:  # removed after the stat, leave the cell blank
+            continue
+        positions[filename] = position
+
+    with atomic_open(get_avatar_path(sprite_filename, makedirs=True)) as f:
+        sprite.save(f, format='png', optimize=True)
+    # the map was written last, it marks the sprite as complete
+    with atomic_open(map_path, 'w') as f:
+        json.dump(positions, f)
+    return sprite_filename, positions
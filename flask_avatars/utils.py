@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_avatars.utils
+    ~~~~~~~~~~~~~~~~~~~
+    Helpers for working with the avatar save path.
+
+    :author: Grey Li <withlihui@gmail.com>
+    :copyright: © 2018 Grey Li
+    :license: MIT, see LICENSE for more details.
+"""
+import functools
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from flask import current_app
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+#: Match the files written by ``save_avatar``.
+RAW_RE = re.compile(r'^(?P<name>.+)_raw\.png$')
+#: Match the size variants written by ``crop_avatar`` (``.webp`` for animated avatars) and
+#: ``Identicon.generate``, and the resized variants (e.g. ``abc_120.png``) written by the
+#: ``avatars.serve_resized`` endpoint.
+VARIANT_RE = re.compile(r'^(?P<name>.+)_(?P<size>s|m|l|\d+)\.(?P<ext>png|webp)$')
+#: Match the sprite images and their position maps written by ``make_sprite``.
+SPRITE_RE = re.compile(r'^(?P<key>[0-9a-f]{32})_sprite\.(?P<ext>png|json)$')
+#: Match the temporary files written by :func:`atomic_open`.
+TMP_RE = re.compile(r'^\..+\.tmp$')
+#: The number of lock files used by :func:`file_lock`, keys were hashed into them.
+LOCK_STRIPES = 256
+
+
+def iter_avatar_files(path):
+    """Walk the save path and yield a ``os.DirEntry`` for every file.
+
+    The scan is streaming (``os.scandir``), so memory usage doesn't depend on
+    the number of entries in a directory.
+
+    :param path: The directory to scan.
+    """
+    stack = [path]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    yield entry
+
+
+def is_avatar_file(filename):
+    """Check if ``filename`` is the name of an avatar image: a raw upload, a size variant or a
+    sprite. Hidden files, paths and the other files in the save path (journals, databases,
+    sprite maps, etc.) are not.
+
+    :param filename: The file name.
+    """
+    if filename.startswith('.') or '/' in filename or '\\' in filename:
+        return False
+    sprite = SPRITE_RE.match(filename)
+    return bool(RAW_RE.match(filename) or VARIANT_RE.match(filename) or (sprite and sprite.group('ext') == 'png'))
+
+
+def avatar_name(filename):
+    """Return the name shared by all the files of an avatar, e.g. ``abc`` for ``abc_m.png``.
+
+    :param filename: The avatar's file name.
+    """
+    match = VARIANT_RE.match(filename) or RAW_RE.match(filename)
+    if match is not None:
+        return match.group('name')
+    return os.path.splitext(filename)[0]
+
+
+def shard_path(filename, depth):
+    """Return the relative path of a file in the sharded layout, e.g. ``ab/cd/abc_m.png``.
+
+    The shard directories come from the MD5 of :func:`avatar_name`, so the raw upload and
+    all the variants of an avatar end up in the same directory.
+
+    :param filename: The avatar's file name.
+    :param depth: The number of shard directory levels, ``0`` means a flat layout.
+    """
+    if not depth:
+        return filename
+    digest = hashlib.md5(avatar_name(filename).encode('utf-8')).hexdigest()
+    parts = [digest[i * 2:i * 2 + 2] for i in range(depth)]
+    return os.path.join(*(parts + [filename]))
+
+
+def resize_sizes(config):
+    """Return the sorted sizes allowed by the ``avatars.serve_resized`` endpoint, ``AVATARS_RESIZE_SIZES``
+    or 1x, 2x and 3x of ``AVATARS_SIZE_TUPLE`` by default.
+
+    :param config: The application config.
+    """
+    sizes = config['AVATARS_RESIZE_SIZES']
+    if sizes is None:
+        sizes = [size * density for size in config['AVATARS_SIZE_TUPLE'] for density in (1, 2, 3)]
+    return sorted(set(int(size) for size in sizes))
+
+
+def clamp_size(px, sizes):
+    """Return the smallest size in ``sizes`` not less than ``px``, or the largest one.
+
+    :param px: The requested size.
+    :param sizes: The sorted allowed sizes.
+    """
+    for size in sizes:
+        if size >= px:
+            return size
+    return sizes[-1]
+
+
+def get_avatar_path(filename, makedirs=False):
+    """Return the absolute path of an avatar file under ``AVATARS_SAVE_PATH``.
+
+    :param filename: The avatar's file name.
+    :param makedirs: Create the shard directories if they don't exist, default to ``False``.
+    """
+    config = current_app.config
+    path = os.path.join(config['AVATARS_SAVE_PATH'], shard_path(filename, config['AVATARS_SHARD_DEPTH']))
+    if makedirs:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def run_in_executor(executor, func, *args):
+    """Run ``func(*args)`` in ``executor`` from a coroutine, return an awaitable.
+
+    :param executor: A ``concurrent.futures.Executor``, ``None`` means the event loop's default
+        (thread pool) executor.
+    :param func: The function to call, it must be picklable for a process pool.
+    """
+    import asyncio
+
+    return asyncio.get_running_loop().run_in_executor(executor, functools.partial(func, *args))
+
+
+_umask = None
+
+
+def _file_mode():
+    """The permission bits of a new file, ``0o666`` without the bits in the process umask."""
+    global _umask
+    if _umask is None:
+        # the umask can only be read by setting it, do it once since it's not thread-safe
+        _umask = os.umask(0o022)
+        os.umask(_umask)
+    return 0o666 & ~_umask
+
+
+@contextmanager
+def atomic_open(path, mode='wb'):
+    """Open a temporary file next to ``path`` for writing, it will be renamed to ``path``
+    (with ``os.replace``) when the ``with`` block exits without error, so readers never
+    see a partially written file. The file gets the permissions of a file created by
+    ``open()`` (``0o666`` without the umask bits), not the ``0o600`` of the temporary file.
+
+    :param path: The destination path.
+    :param mode: The file mode, default to ``'wb'``.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                    prefix='.' + os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.chmod(tmp_path, _file_mode())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Coalesce concurrent calls with the same key in a process: the first caller runs the
+    function, the others wait for it and get the same result (or exception). To coalesce
+    across processes, the function should hold a :func:`file_lock` and check whether the
+    work was already done by another process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        """Call ``func(*args, **kwargs)``, or wait for the in-flight call of ``key``.
+
+        :param key: A hashable key of the call.
+        :param func: The function to call.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class SQLiteStore(object):
+    """The base of the stores in a SQLite database file shared by all the processes on a host.
+    The database uses WAL mode, each thread of each process has its own connection, so the
+    stores can be used in thread pools, forked workers and pickled to process pools.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def __getstate__(self):
+        # connections are per thread and per process, don't pickle them
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _connect(self):
+        import sqlite3
+
+        # Connections can't be shared between threads, or across ``fork()``.
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        self._create_tables(conn)
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def _create_tables(self, conn):
+        """Create the tables if they don't exist, called with each new connection."""
+        raise NotImplementedError
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(cls, path, *args, **kwargs):
+    """Return the :class:`SQLiteStore` of ``cls`` at ``path``, one instance per process, so the
+    connections are reused. The arguments are only used to create the instance.
+
+    :param cls: A subclass of :class:`SQLiteStore`.
+    :param path: The path of the database file.
+    """
+    with _stores_lock:
+        store = _stores.get((cls, path))
+        if store is None:
+            store = _stores[(cls, path)] = cls(path, *args, **kwargs)
+        return store
+
+
+_held = threading.local()
+
+
+@contextmanager
+def file_lock(lock_path, key):
+    """Hold an exclusive lock of ``key`` that shared by all the processes on the host.
+
+    Keys were hashed into :data:`LOCK_STRIPES` lock files in ``lock_path``, so the number
+    of lock files is bounded. Nothing will be locked if ``lock_path`` is ``None`` or
+    ``fcntl`` is not available.
+
+    A thread never holds two lock files: two keys may share a stripe (``flock`` locks from
+    different file descriptors conflict even in one process), and two nested stripes taken
+    in the opposite order by two workers deadlock each other. A nested call runs under the
+    outer lock, without locking again.
+
+    :param lock_path: The directory of lock files, ``AVATARS_LOCK_PATH``.
+    :param key: A key with a stable ``repr()``.
+    """
+    if lock_path is None or fcntl is None or getattr(_held, 'locked', False):
+        yield
+        return
+    os.makedirs(lock_path, exist_ok=True)
+    stripe = int(hashlib.md5(repr(key).encode('utf-8')).hexdigest(), 16) % LOCK_STRIPES
+    with open(os.path.join(lock_path, 'flight-%d.lock' % stripe), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        _held.locked = True
+        try:
+            yield
+        finally:
+            _held.locked = False
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def files_fresh(paths, since):
+    """Check if all the files exist and were modified after ``since`` (a timestamp).
+
+    :param paths: The file paths.
+    :param since: The timestamp.
+    """
+    try:
+        return all(os.stat(path).st_mtime >= since for path in paths)
+    except FileNotFoundError:
+        return False
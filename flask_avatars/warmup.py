@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_avatars.warmup
+    ~~~~~~~~~~~~~~~~~~~~
+    Render the identicons of known users in the background, so the first
+    requests after a deploy don't render them from cold.
+
+    :author: Grey Li <withlihui@gmail.com>
+    :copyright: © 2018 Grey Li
+    :license: MIT, see LICENSE for more details.
+"""
+import os
+import threading
+import time
+
+from .identicon import Identicon
+
+
+def iter_texts(texts):
+    """Iterate the texts of a warm-up source, empty texts were skipped.
+
+    :param texts: An iterable of texts, a callable returns the iterable, or the path of
+        a text file with one text per line.
+    """
+    if callable(texts):
+        texts = texts()
+    if isinstance(texts, (str, os.PathLike)):
+        with open(texts, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield line
+        return
+    for text in texts:
+        if text:
+            yield str(text)
+
+
+class WarmUp(object):
+
+    def __init__(self, app, texts, sizes=None, interval=None, log_every=100):
+        """Render the identicons of ``texts`` in a daemon thread, see :meth:`Avatars.warm_up`.
+
+        The rendered images go to the identicon cache (``AVATARS_CACHE`` or ``AVATARS_IDENTICON_CACHE``).
+        Without a cache, the avatar files that don't exist yet will be generated instead.
+
+        :param app: The application, the thread runs in its application context.
+        :param texts: The texts, see :func:`iter_texts`.
+        :param sizes: The sizes to render into the cache, default to ``AVATARS_SIZE_TUPLE``.
+        :param interval: The seconds to sleep after each text, so the live requests won't be
+               starved, default to ``AVATARS_WARMUP_INTERVAL``.
+        :param log_every: Log the progress every this many texts.
+        """
+        self.app = app
+        self.texts = texts
+        self.sizes = tuple(sizes or app.config['AVATARS_SIZE_TUPLE'])
+        self.interval = app.config['AVATARS_WARMUP_INTERVAL'] if interval is None else interval
+        self.log_every = log_every
+        #: The number of texts, ``None`` if the source has no length.
+        self.total = len(texts) if hasattr(texts, '__len__') and not isinstance(texts, str) else None
+        self.done = 0
+        self.failed = 0
+        self.started = None
+        self.finished = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='flask-avatars-warm-up', daemon=True)
+
+    @property
+    def running(self):
+        """Whether the warm-up is still running."""
+        return self._thread.is_alive()
+
+    @property
+    def elapsed(self):
+        """The seconds the warm-up took (or has taken so far)."""
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def progress(self):
+        """A dict of the rendered and failed counts, the total count and the elapsed seconds."""
+        return {
+            'done': self.done,
+            'failed': self.failed,
+            'total': self.total,
+            'elapsed': self.elapsed,
+            'running': self.running,
+        }
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def join(self, timeout=None):
+        """Wait until the warm-up finished, return ``True`` if it did.
+
+        :param timeout: The seconds to wait, ``None`` to wait forever.
+        """
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    def stop(self):
+        """Stop after the current text."""
+        self._stop.set()
+
+    def _run(self):
+        logger = self.app.logger
+        self.started = time.monotonic()
+        try:
+            with self.app.app_context():
+                renderer = Identicon()
+                for text in iter_texts(self.texts):
+                    if self._stop.is_set():
+                        break
+                    try:
+                        self._render(renderer, text)
+                    except Exception:
+                        self.failed += 1
+                        logger.exception('Failed to warm up the identicon of %r.', text)
+                    else:
+                        self.done += 1
+                    if self.log_every and (self.done + self.failed) % self.log_every == 0:
+                        logger.info('Warmed up %d/%s identicons in %.2fs.', self.done,
+                                    self.total if self.total is not None else '?', self.elapsed)
+                    if self.interval:
+                        self._stop.wait(self.interval)
+        except Exception:
+            logger.exception('Identicon warm-up aborted.')
+        finally:
+            self.finished = time.monotonic()
+            logger.info('Warmed up %d identicons (%d failed) in %.2fs.', self.done, self.failed, self.elapsed)
+
+    def _render(self, renderer, text):
+        if renderer.cache is not None:
+            for size in self.sizes:
+                renderer.get_image(text, int(size), int(size), int(size * 0.1))
+            return
+        # no cache, generate the avatar files that don't exist yet
+        options = renderer._save_options()
+        files, paths = renderer._targets(text, options['save_path'], options['sizes'], options['shard_depth'])
+        if not all(os.path.exists(path) for path in paths):
+            renderer.generate(text)
@@ -7,14 +7,36 @@
     :copyright: © 2018 Grey Li
     :license: MIT, see LICENSE for more details.
 """
+import asyncio
 import hashlib
 import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
 import unittest
+import zipfile
+from io import BytesIO
+from unittest import mock
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-from PIL import Image
-from flask import Flask, render_template_string, current_app
+from PIL import Image, ImageDraw
+from flask import Flask, render_template_string, current_app, url_for
+from werkzeug.datastructures import FileStorage
 
-from flask_avatars import Avatars, _Avatars, Identicon
+from flask_avatars import Avatars, _Avatars, Identicon, IdenticonRenderer, DecodeBudgetExceeded, DecodeLimiter, \
+    InvalidCropError, GravatarMixin, estimate_file_memory, backfill_gravatar_hashes, gravatar_hash
+from flask_avatars.cache import DictCache, RedisCache, SQLiteCache, file_cache_key
+from flask_avatars.utils import SingleFlight, atomic_open, file_lock, shard_path
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
@@ -29,6 +51,7 @@ class AvatarsTestCase(unittest.TestCase):
 
         self.email_hash = hashlib.md5('test@helloflask.com'.lower().encode('utf-8')).hexdigest()
 
+        self.app.config['AVATARS_SERVE_FILES'] = True
         avatars = Avatars(self.app)  # noqa
 
         self.real_avatars = avatars
@@ -187,6 +210,37 @@ class AvatarsTestCase(unittest.TestCase):
 
         os.remove(os.path.join(basedir, 'test.png'))
 
+    def test_crop_avatar_lock(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        current_app.config.update(AVATARS_SAVE_PATH=path, AVATARS_LOCK_PATH=os.path.join(path, 'locks'))
+        self.addCleanup(current_app.config.update, AVATARS_LOCK_PATH=None)
+        img = Image.new(mode='RGB', size=(800, 800), color=(255, 0, 0))
+        img.paste((0, 0, 255), (400, 0, 800, 800))
+        raw = self.real_avatars.save_avatar(img)
+        filenames = self.real_avatars.crop_avatar(raw, x=0, y=0, w=100, h=100, uuid_filename=False)
+        paths = [os.path.join(path, filename) for filename in filenames]
+
+        # the files written by another crop while waiting for the lock are cropped again
+        locked = threading.Event()
+        lock_path = current_app.config['AVATARS_LOCK_PATH']
+
+        def other_crop():
+            with file_lock(lock_path, ('crop', paths[0])):
+                locked.set()
+                time.sleep(0.2)
+                for p in paths:
+                    os.utime(p)
+
+        thread = threading.Thread(target=other_crop)
+        thread.start()
+        locked.wait(5)
+        self.assertEqual(self.real_avatars.crop_avatar(raw, x=400, y=0, w=100, h=100, uuid_filename=False),
+                         filenames)
+        thread.join()
+        with Image.open(paths[0]) as file_s:
+            self.assertEqual(file_s.convert('RGB').getpixel((0, 0)), (0, 0, 255))
+
     def test_crop_default_avatar(self):
         current_app.config['AVATARS_SAVE_PATH'] = basedir
         filenames = self.real_avatars.crop_avatar(None, x=1, y=1, w=100, h=100)
@@ -241,3 +295,788 @@ class AvatarsTestCase(unittest.TestCase):
         # comment out these two lines to check the generated image, then delete them manually.
         for filename in filenames:
             os.remove(os.path.join(basedir, filename))
+
+    def test_clean_avatars(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        current_app.config['AVATARS_SAVE_PATH'] = path
+        for filename in ('old_raw.png', 'new_raw.png', 'live_s.png', 'dead_s.png', 'other.txt', '.old_s.png.1.tmp'):
+            open(os.path.join(path, filename), 'wb').close()
+        past = time.time() - 2 * current_app.config['AVATARS_RAW_TTL']
+        os.utime(os.path.join(path, 'old_raw.png'), (past, past))
+        os.utime(os.path.join(path, '.old_s.png.1.tmp'), (past, past))
+
+        removed = []
+        self.assertEqual(self.real_avatars.clean_avatars(dry_run=True, callback=removed.append), 2)
+        self.assertEqual(sorted(removed), ['.old_s.png.1.tmp', 'old_raw.png'])
+        self.assertTrue(os.path.exists(os.path.join(path, 'old_raw.png')))
+
+        removed = []
+        self.assertEqual(self.real_avatars.clean_avatars(live={'live_s.png'}, callback=removed.append), 3)
+        self.assertEqual(sorted(removed), ['.old_s.png.1.tmp', 'dead_s.png', 'old_raw.png'])
+        self.assertEqual(sorted(os.listdir(path)), ['live_s.png', 'new_raw.png', 'other.txt'])
+
+    def test_clean_command(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        current_app.config['AVATARS_SAVE_PATH'] = path
+        open(os.path.join(path, 'dead_m.png'), 'wb').close()
+
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=['avatars', 'clean', '--live', '-', '--dry-run'], input='live_m.png\n')
+        self.assertIn('dead_m.png', result.output)
+        self.assertTrue(os.path.exists(os.path.join(path, 'dead_m.png')))
+
+        result = runner.invoke(args=['avatars', 'clean', '--live', '-'], input='live_m.png\n')
+        self.assertEqual(result.exit_code, 0)
+        self.assertFalse(os.path.exists(os.path.join(path, 'dead_m.png')))
+
+    def test_migrate_avatars(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        current_app.config['AVATARS_SAVE_PATH'] = path
+        current_app.config['AVATARS_SHARD_DEPTH'] = 1
+        img = Image.new(mode='RGB', size=(800, 800), color=(125, 125, 125))
+        img.paste((200, 100, 100), (0, 0, 400, 400))
+        filenames = self.real_avatars.crop_avatar(self.real_avatars.save_avatar(img), x=1, y=1, w=300, h=300)
+        paths = [os.path.join(path, shard_path(filename, 1)) for filename in filenames]
+        with open(os.path.join(path, 'bad_m.png'), 'wb') as f:
+            f.write(b'not a png')
+        before = []
+        for p in paths:
+            with Image.open(p) as im:
+                before.append(im.convert('RGB').tobytes())
+
+        report = self.real_avatars.migrate_avatars(workers=0)
+        self.assertEqual((report.migrated, report.failed), (3, 1))
+        self.assertEqual(report.errors[0][0], 'bad_m.png')
+        self.assertGreater(report.bytes_saved, 0)
+        for p, pixels in zip(paths, before):
+            with Image.open(p) as im:
+                self.assertEqual(im.mode, 'P')
+                self.assertEqual(im.convert('RGB').tobytes(), pixels)
+
+        # resume, only the failed file was retried
+        report = self.real_avatars.migrate_avatars(workers=0)
+        self.assertEqual((report.files, report.failed), (1, 1))
+
+        current_app.config['AVATARS_SIZE_TUPLE'] = (20, 40, 150)
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=['avatars', 'migrate', '--resize', '--restart', '--workers', '1'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('bad_m.png', result.output)
+        self.assertIn('2 migrated', result.output)
+        for p, width in zip(paths, (20, 40, 150)):
+            with Image.open(p) as im:
+                self.assertEqual(im.size, (width, width))
+
+        # the identicons were resized with their padding
+        identicons = [os.path.join(path, shard_path(filename, 1)) for filename in Identicon().generate(text='grey')]
+        current_app.config['AVATARS_SIZE_TUPLE'] = (10, 30, 150)
+        report = self.real_avatars.migrate_avatars(resize=True, restart=True, workers=0)
+        self.assertEqual(report.failed, 1)
+        for p, width in zip(paths + identicons, (10, 30, 150, 12, 36, 180)):
+            with Image.open(p) as im:
+                self.assertEqual(im.size, (width, width))
+
+        # the _l files can't be resized from themselves
+        current_app.config['AVATARS_SIZE_TUPLE'] = (10, 30, 200)
+        report = self.real_avatars.migrate_avatars(resize=True, restart=True, workers=0)
+        self.assertEqual(report.failed, 7)
+        self.assertIn('crop or generate the avatar again', dict(report.errors)[shard_path(filenames[0], 1)])
+        for p, width in zip(paths + identicons, (10, 30, 150, 12, 36, 180)):
+            with Image.open(p) as im:
+                self.assertEqual(im.size, (width, width))
+
+    def test_sharded_layout(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        current_app.config['AVATARS_SAVE_PATH'] = path
+        img = Image.new(mode='RGB', size=(800, 800), color=(125, 125, 125))
+        flat = self.real_avatars.save_avatar(img)
+
+        for filename in ('dedupe.sqlite', 'dedupe.sqlite-wal', 'notes.txt'):
+            with open(os.path.join(path, filename), 'wb') as f:
+                f.write(b'data')
+
+        current_app.config['AVATARS_SHARD_DEPTH'] = 2
+        moved = []
+        self.assertEqual(self.real_avatars.shard_avatars(callback=lambda old, new: moved.append((old, new))), 1)
+        self.assertEqual(moved, [(flat, shard_path(flat, 2))])
+        for filename in ('dedupe.sqlite', 'dedupe.sqlite-wal', 'notes.txt'):
+            self.assertTrue(os.path.exists(os.path.join(path, filename)))
+        self.assertEqual(len(shard_path(flat, 2).split(os.sep)), 3)
+
+        filenames = self.real_avatars.crop_avatar(flat, x=1, y=1, w=100, h=100)
+        self.assertEqual(len(set(os.path.dirname(shard_path(filename, 2)) for filename in filenames)), 1)
+        for filename in filenames:
+            self.assertTrue(os.path.exists(os.path.join(path, shard_path(filename, 2))))
+            response = self.client.get(url_for('avatars.serve_avatar', filename=filename))
+            self.assertEqual(response.status_code, 200)
+            response.close()
+
+        filenames = Identicon().generate(text='grey')
+        self.assertTrue(os.path.exists(os.path.join(path, shard_path(filenames[0], 2))))
+
+        response = self.client.get(url_for('avatars.serve_avatar', filename='missing_s.png'))
+        self.assertEqual(response.status_code, 404)
+
+    def test_serve_avatar_files_only(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        for filename in ('.avatars-migrate.journal', 'dedupe.sqlite', 'grey_s.png', 'grey.png'):
+            with open(os.path.join(path, filename), 'wb') as f:
+                f.write(b'data')
+
+        # no save path, e.g. a Gravatar only app
+        self.assertEqual(self.client.get('/avatars/files/grey_s.png').status_code, 404)
+        self.assertEqual(self.client.get('/avatars/files/grey/60').status_code, 404)
+        current_app.config['AVATARS_SAVE_PATH'] = path
+        response = self.client.get('/avatars/files/grey_s.png')
+        self.assertEqual(response.status_code, 200)
+        response.close()
+        for filename in ('.avatars-migrate.journal', 'dedupe.sqlite', 'grey.png', '.grey_s.png'):
+            self.assertEqual(self.client.get('/avatars/files/' + filename).status_code, 404)
+        self.assertEqual(self.client.get('/avatars/files/.grey/60').status_code, 404)
+
+        # the files are not served by default
+        app = Flask(__name__)
+        app.config['AVATARS_SAVE_PATH'] = path
+        Avatars(app)
+        self.assertEqual(app.test_client().get('/avatars/files/grey_s.png').status_code, 404)
+
+    def test_img(self):
+        rv = render_template_string("{{ avatars.img(gravatar='%s', size='s', alt='<Grey>') }}" % self.email_hash)
+        self.assertIn('src="https://gravatar.com/avatar/%s?s=30&amp;r=g&amp;d=identicon"' % self.email_hash, rv)
+        self.assertIn('?s=150&amp;r=g&amp;d=identicon 150w"', rv)
+        self.assertIn('sizes="30px" width="30" height="30" alt="&lt;Grey&gt;" loading="lazy" decoding="async"', rv)
+
+        rv = self.avatars.img(identicon='grey')
+        self.assertIn('src="/avatars/files/grey_m.png"', rv)
+        self.assertIn('srcset="/avatars/files/grey_s.png 36w, /avatars/files/grey_m.png 72w, '
+                      '/avatars/files/grey_l.png 180w"', rv)
+
+        rv = self.avatars.img(filename='abc_m.webp', size=100, class_='avatar', data_id=1)
+        self.assertIn('src="/avatars/files/abc_l.webp"', rv)
+        self.assertIn('width="100" height="100"', rv)
+        self.assertIn('class="avatar" data-id="1"', rv)
+        self.assertIn('default/default_s.jpg 48w', self.avatars.img())
+
+    def test_gravatar_mixin(self):
+        class User(GravatarMixin):
+            def __init__(self, email=None):
+                self.email = email
+
+        self.assertEqual(gravatar_hash(' Test@HelloFlask.com '), self.email_hash)
+        self.assertIsNone(gravatar_hash(''))
+        user = User('Test@HelloFlask.com')
+        self.assertEqual(user.email_hash, self.email_hash)
+        self.assertEqual(user.gravatar_url(size=30), self.avatars.gravatar(self.email_hash, size=30))
+        user.email = 'other@helloflask.com'
+        self.assertNotEqual(user.email_hash, self.email_hash)
+        user.email = None
+        self.assertIsNone(user.email_hash)
+
+        class Row(object):  # rows loaded from the database, the hash was not set
+            def __init__(self, email, email_hash=None):
+                self.email, self.email_hash = email, email_hash
+
+        rows = [Row('a%d@example.com' % n) for n in range(5)] + [Row(None), Row('b@example.com', 'stale')]
+        commits = []
+        self.assertEqual(backfill_gravatar_hashes(rows, commit=lambda: commits.append(1), chunk_size=3), 6)
+        self.assertEqual(len(commits), 3)
+        self.assertEqual(rows[0].email_hash, gravatar_hash('a0@example.com'))
+        self.assertEqual(backfill_gravatar_hashes(rows), 0)
+
+        rows = [Row('a%d@example.com' % n) for n in range(5)] + [Row(None)]
+
+        def next_chunk(size):  # like a query filtered by email_hash=None
+            return [row for row in rows if row.email_hash is None][:size]
+        self.assertEqual(backfill_gravatar_hashes(next_chunk, chunk_size=2), 5)
+
+    def test_sprite(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        current_app.config['AVATARS_SAVE_PATH'] = path
+        filenames = [Identicon().generate(text=text)[0] for text in ('a', 'b', 'c')]
+
+        sprite_filename, positions = self.real_avatars.make_sprite(filenames)
+        self.assertEqual(sorted(positions), sorted(filenames))
+        self.assertEqual(positions[filenames[0]], (0, 0))
+        with Image.open(os.path.join(path, sprite_filename)) as sprite:
+            self.assertEqual(sprite.size, (60, 60))
+        self.assertEqual(self.real_avatars.make_sprite(reversed(filenames)), (sprite_filename, positions))
+
+        rv = render_template_string('{{ avatars.sprite_css(filenames) }}{{ avatars.sprite_icon(filenames[1]) }}',
+                                    filenames=filenames)
+        self.assertIn('background-image:url(/avatars/files/%s);background-position:-30px -0px' % sprite_filename, rv)
+        self.assertIn('.avatars-sprite{display:inline-block;width:30px;height:30px;}', rv)
+        self.assertIn('<span class="avatars-sprite avatars-sprite-', rv)
+
+        # a changed avatar is packed into a new sprite, a missing one was skipped
+        os.utime(os.path.join(path, filenames[0]), (0, 0))
+        changed_filename, positions = self.real_avatars.make_sprite(filenames + ['missing_s.png'])
+        self.assertNotEqual(changed_filename, sprite_filename)
+        self.assertEqual(sorted(positions), sorted(filenames))
+
+        # the old sprites were cleaned up
+        past = time.time() - 2 * current_app.config['AVATARS_SPRITE_TTL']
+        for filename in (sprite_filename, sprite_filename.replace('.png', '.json')):
+            os.utime(os.path.join(path, filename), (past, past))
+        removed = []
+        self.assertEqual(self.real_avatars.clean_avatars(callback=removed.append), 2)
+        self.assertEqual(sorted(removed), sorted([sprite_filename, sprite_filename.replace('.png', '.json')]))
+        self.assertTrue(os.path.exists(os.path.join(path, changed_filename)))
+
+    def test_export_avatars(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        current_app.config['AVATARS_SAVE_PATH'] = path
+        current_app.config['AVATARS_SHARD_DEPTH'] = 1
+        current_app.config['AVATARS_CACHE'] = cache = DictCache()
+        self.addCleanup(current_app.config.update, AVATARS_SHARD_DEPTH=0, AVATARS_CACHE=None)
+        filenames = Identicon().generate(text='grey')
+        cache.set(file_cache_key('remote_m.png'), b'cached')
+        with open(os.path.join(path, shard_path(filenames[2], 1)), 'rb') as f:
+            large = f.read()
+
+        rv = self.real_avatars.export_avatars(filenames + ['remote_m.png', 'missing_m.png'])
+        self.assertEqual(rv.mimetype, 'application/zip')
+        self.assertEqual(rv.headers['Content-Disposition'], 'attachment; filename="avatars.zip"')
+        self.assertTrue(rv.is_streamed)
+        archive = zipfile.ZipFile(BytesIO(b''.join(rv.response)))
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(archive.namelist(), filenames + ['remote_m.png'])
+        self.assertEqual(archive.read(filenames[2]), large)
+        self.assertEqual(archive.read('remote_m.png'), b'cached')
+
+        rv = self.real_avatars.export_avatars(filenames + ['remote_m.png'], format='tar', download_name='grey.tar')
+        self.assertEqual(rv.mimetype, 'application/x-tar')
+        self.assertIn('filename="grey.tar"', rv.headers['Content-Disposition'])
+        data = b''.join(rv.response)
+        self.assertEqual(len(data) % tarfile.RECORDSIZE, 0)
+        with tarfile.open(fileobj=BytesIO(data)) as archive:
+            self.assertEqual(archive.getnames(), filenames + ['remote_m.png'])
+            self.assertEqual(archive.extractfile(filenames[2]).read(), large)
+            self.assertEqual(archive.extractfile('remote_m.png').read(), b'cached')
+        self.assertRaises(ValueError, self.real_avatars.export_avatars, filenames, format='rar')
+        self.assertRaises(ValueError, self.real_avatars.export_avatars, filenames + ['../../etc/passwd'])
+        self.assertRaises(ValueError, self.real_avatars.export_avatars, ['dedupe.sqlite'])
+
+        # the cached files are fetched when they're written
+        rv = self.real_avatars.export_avatars(['late_m.png'])
+        cache.set(file_cache_key('late_m.png'), b'late')
+        self.assertEqual(zipfile.ZipFile(BytesIO(b''.join(rv.response))).read('late_m.png'), b'late')
+
+    def test_decode_limiter(self):
+        limiter = DecodeLimiter(budget=100, timeout=0)
+        with limiter.limit(60):
+            self.assertEqual(limiter.metrics['in_use'], 60)
+            self.assertRaises(DecodeBudgetExceeded, limiter.acquire, 60)
+        self.assertRaises(DecodeBudgetExceeded, limiter.acquire, 200)
+        self.assertEqual(limiter.metrics['in_use'], 0)
+        self.assertEqual(limiter.metrics['admitted'], 1)
+        self.assertEqual(limiter.metrics['rejected'], 2)
+
+        limiter = DecodeLimiter(budget=100, timeout=5)
+        limiter.acquire(60)
+        threading.Timer(0.05, limiter.release, args=(60,)).start()
+        with limiter.limit(60):
+            self.assertEqual(limiter.metrics['admitted'], 2)
+
+    def test_crop_avatar_decode_budget(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        current_app.config['AVATARS_SAVE_PATH'] = path
+        Image.new(mode='RGB', size=(100, 100)).save(os.path.join(path, 'test.png'))
+
+        self.real_avatars.limiter = DecodeLimiter(budget=100 * 100 * 3 - 1, timeout=0)
+        self.assertRaises(DecodeBudgetExceeded, self.real_avatars.crop_avatar, 'test.png', x=1, y=1, w=30, h=30)
+        self.real_avatars.limiter = DecodeLimiter(budget=100 * 100 * 3, timeout=0)
+        self.real_avatars.crop_avatar('test.png', x=1, y=1, w=30, h=30)
+        self.assertEqual(self.real_avatars.limiter.metrics['admitted'], 1)
+
+        # a cancelled crop still releases the budget, after the decoding finished
+        limiter = self.real_avatars.limiter = DecodeLimiter(budget=100 * 100 * 3, timeout=5)
+        limiter.acquire(100 * 100 * 3)
+        threading.Timer(0.2, limiter.release, args=(100 * 100 * 3,)).start()
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(asyncio.wait_for(self.real_avatars.crop_avatar_async('test.png', x=1, y=1, w=30, h=30), 0.05))
+        self.assertEqual(limiter.metrics['admitted'], 2)
+        self.assertEqual(limiter.metrics['in_use'], 0)
+
+    def test_crop_avatar_invalid_box(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        current_app.config['AVATARS_SAVE_PATH'] = path
+        Image.new(mode='RGB', size=(100, 100), color=(125, 125, 125)).save(os.path.join(path, 'test.png'))
+
+        for box in (('a', 1, 2, 3), (None, 1, 2, 3), (1, 1, 0, 10), (1, 1, 10, -1), (100, 0, 10, 10),
+                    (0, 200, 10, 10), (-50, 0, 50, 50)):
+            self.assertRaises(InvalidCropError, self.real_avatars.crop_avatar, 'test.png', *box)
+        self.assertEqual(self.real_avatars.limiter.metrics['admitted'], 0)  # rejected before decoding
+        self.assertTrue(issubclass(InvalidCropError, ValueError))
+
+        filenames = self.real_avatars.crop_avatar('test.png', x='50.0', y=-10, w=100000, h=100000)
+        self.assertEqual(self.real_avatars.limiter.metrics['admitted'], 1)
+        with Image.open(os.path.join(path, filenames[2])) as img:
+            self.assertEqual(img.size, (150, 150))
+            self.assertEqual(img.convert('RGB').getpixel((149, 149)), (125, 125, 125))  # not padded
+
+        with self.assertRaises(InvalidCropError):
+            asyncio.run(self.real_avatars.crop_avatar_async('test.png', x=0, y=100, w=10, h=10))
+
+    def test_crop_avatar_exif(self):
+        from PIL import ImageCms
+
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        current_app.config['AVATARS_SAVE_PATH'] = path
+        img = Image.new(mode='RGB', size=(200, 100), color=(0, 0, 255))
+        img.paste((255, 0, 0), (0, 0, 100, 100))
+        exif = img.getexif()
+        exif[0x0112] = 6  # stored sideways, the upright image is 100x200 with red on top
+        icc = ImageCms.ImageCmsProfile(ImageCms.createProfile('sRGB')).tobytes()
+        img.save(os.path.join(path, 'photo.jpg'), exif=exif.tobytes(), icc_profile=icc, quality=95)
+
+        filenames = self.real_avatars.crop_avatar('photo.jpg', x=0, y=0, w=100, h=100)
+        with Image.open(os.path.join(path, filenames[2])) as cropped:
+            self.assertEqual(cropped.size, (150, 150))
+            r, g, b = cropped.convert('RGB').getpixel((75, 75))
+            self.assertTrue(r > 200 and b < 50)
+            self.assertNotIn('icc_profile', cropped.info)
+            self.assertNotIn('exif', cropped.info)
+
+        filename = self.real_avatars.save_avatar(Image.open(os.path.join(path, 'photo.jpg')))
+        with Image.open(os.path.join(path, filename)) as raw:
+            self.assertEqual(raw.size, (100, 200))
+            self.assertNotIn('icc_profile', raw.info)
+
+    def test_crop_animated_avatar(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        current_app.config['AVATARS_SAVE_PATH'] = path
+        frames = [Image.new('RGB', (300, 200), (index * 20, 0, 0)) for index in range(10)]
+        frames[0].save(os.path.join(path, 'anim.gif'), save_all=True, append_images=frames[1:], duration=50, loop=0)
+
+        filenames = self.real_avatars.crop_avatar('anim.gif', x=10, y=10, w=100, h=100)
+        self.assertTrue(filenames[0].endswith('_s.png'))  # disabled by default
+
+        current_app.config.update(AVATARS_ANIMATED=True, AVATARS_ANIMATED_MAX_FRAMES=6,
+                                  AVATARS_ANIMATED_MAX_DURATION=None)
+        filenames = self.real_avatars.crop_avatar('anim.gif', x=10, y=10, w=100, h=100)
+        self.assertEqual([filename[-7:] for filename in filenames], ['_s.webp', '_m.webp', '_l.webp'])
+        for filename, size in zip(filenames, (30, 60, 150)):
+            with Image.open(os.path.join(path, filename)) as img:
+                self.assertEqual((img.format, img.size, img.n_frames), ('WEBP', (size, size), 6))
+
+        current_app.config.update(AVATARS_ANIMATED_MAX_DURATION=120)
+        filenames = asyncio.run(self.real_avatars.crop_avatar_async('anim.gif', x=10, y=10, w=100, h=100))
+        with Image.open(os.path.join(path, filenames[2])) as img:
+            self.assertEqual(img.n_frames, 2)
+        current_app.config.update(AVATARS_ANIMATED_MAX_DURATION=None, AVATARS_ANIMATED_MAX_PIXELS=300 * 200 * 3)
+        filenames = self.real_avatars.crop_avatar('anim.gif', x=10, y=10, w=100, h=100, uuid_filename=False)
+        self.assertEqual(filenames[0], 'anim.gif_s.webp')
+        with Image.open(os.path.join(path, filenames[2])) as img:
+            self.assertEqual(img.n_frames, 3)
+
+        # the P mode frames were converted to RGBA, estimated at 4 bands for each frame buffer
+        self.assertEqual(estimate_file_memory(os.path.join(path, 'anim.gif')), 300 * 200 * 4 * 2)
+        self.real_avatars.limiter = DecodeLimiter(budget=300 * 200 * 4, timeout=0)
+        self.assertRaises(DecodeBudgetExceeded, self.real_avatars.crop_avatar, 'anim.gif', x=10, y=10, w=100, h=100)
+
+    def test_lazy_import(self):
+        code = 'import sys, flask_avatars; sys.exit(any(m == "PIL" or m.startswith("PIL.") for m in sys.modules))'
+        self.assertEqual(subprocess.call([sys.executable, '-c', code], cwd=basedir), 0)
+        # the modules of the async, cache, migrate and export features were imported when used
+        for module in ('asyncio', 'concurrent.futures', 'multiprocessing', 'sqlite3', 'tarfile'):
+            code = 'import sys, flask_avatars; sys.exit(%r in sys.modules)' % module
+            self.assertEqual(subprocess.call([sys.executable, '-c', code], cwd=basedir), 0, module)
+
+    def test_sqlite_cache(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        cache = SQLiteCache(os.path.join(path, 'cache.db'), max_size=250)
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', b'a' * 100)
+        cache.set('b', b'b' * 100)
+        self.assertEqual(cache.get('a'), b'a' * 100)
+        cache.set('c', b'c' * 100)  # evict the oldest one
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('c'), b'c' * 100)
+
+        other = SQLiteCache(os.path.join(path, 'cache.db'))  # like another process
+        self.assertEqual(other.get('b'), b'b' * 100)
+
+    def test_identicon_cache(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        current_app.config['AVATARS_IDENTICON_CACHE'] = os.path.join(path, 'cache.db')
+        current_app.config['AVATARS_IDENTICON_FG'] = (200, 100, 100)
+        current_app.config['AVATARS_IDENTICON_BG'] = (240, 240, 240)
+
+        avatar = Identicon()
+        image = avatar.get_image('grey', 60, 60)
+        self.assertEqual(avatar.cache.get(avatar._cache_key('grey', 60, 60, 0)), image)
+
+        avatar = Identicon()
+        avatar._render = None  # must be served by the cache
+        self.assertEqual(avatar.get_image('grey', 60, 60), image)
+
+    def test_dict_cache(self):
+        cache = DictCache()
+        cache.set('a', b'a')
+        cache.set('b', b'b', timeout=0.01)
+        self.assertEqual(cache.get_many('a', 'b', 'c'), [b'a', b'b', None])
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('b'))
+
+    @unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+    def test_redis_cache(self):
+        cache = RedisCache(fakeredis.FakeRedis())
+        cache.set('a', b'a')
+        cache.set('b', b'b', timeout=60)
+        self.assertEqual(cache.get('a'), b'a')
+        self.assertEqual(cache.get_many('a', 'b', 'c'), [b'a', b'b', None])
+        self.assertEqual(cache.client.ttl('flask_avatars:b'), 60)
+
+    def test_serve_avatar_from_cache(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        current_app.config['AVATARS_SAVE_PATH'] = path
+        current_app.config['AVATARS_CACHE'] = cache = DictCache()
+        Image.new(mode='RGB', size=(100, 100)).save(os.path.join(path, 'test.png'))
+
+        filenames = self.real_avatars.crop_avatar('test.png', x=1, y=1, w=30, h=30)
+        filenames += Identicon().generate(text='grey')
+        for filename in filenames:
+            with open(os.path.join(path, filename), 'rb') as f:
+                self.assertEqual(cache.get('file:' + filename), f.read())
+            os.remove(os.path.join(path, filename))  # like a cold node
+
+            response = self.client.get(url_for('avatars.serve_avatar', filename=filename))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, 'image/png')
+            self.assertEqual(response.data, cache.get('file:' + filename))
+
+    def test_serve_resized(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        current_app.config['AVATARS_SAVE_PATH'] = path
+        current_app.config['AVATARS_SHARD_DEPTH'] = 1
+        filenames = Identicon().generate(text='grey')
+
+        response = self.client.get(url_for('avatars.serve_resized', name='grey', px=100))
+        self.assertEqual(response.status_code, 200)
+        with Image.open(BytesIO(response.data)) as img:
+            self.assertEqual(img.size, (120, 120))  # clamped to the allowed sizes
+        self.assertTrue(os.path.exists(os.path.join(path, shard_path('grey_120.png', 1))))
+        response.close()
+
+        # resized again after the _l file was rewritten
+        large = os.path.join(path, shard_path(filenames[2], 1))
+        Image.new(mode='RGB', size=(180, 180), color=(255, 0, 0)).save(large)
+        os.utime(large, (time.time() + 10, time.time() + 10))
+        response = self.client.get(url_for('avatars.serve_resized', name='grey', px=120))
+        with Image.open(BytesIO(response.data)) as img:
+            self.assertEqual(img.convert('RGB').getpixel((60, 60)), (255, 0, 0))
+        response.close()
+
+        # not larger than the _l file
+        response = self.client.get(url_for('avatars.serve_resized', name='grey_m.png', px=1000))
+        with open(os.path.join(path, shard_path(filenames[2], 1)), 'rb') as f:
+            self.assertEqual(response.data, f.read())
+        response.close()
+        self.assertEqual(self.client.get(url_for('avatars.serve_resized', name='foo', px=60)).status_code, 404)
+
+        self.assertEqual(self.avatars.srcset('grey_s.png', 40),
+                         '/avatars/files/grey/60 1x, /avatars/files/grey/90 2x, /avatars/files/grey/120 3x')
+        self.assertEqual(self.real_avatars.clean_avatars(live=filenames), 0)
+        removed = []
+        self.real_avatars.clean_avatars(live=[], callback=removed.append)
+        self.assertEqual(sorted(removed), sorted(shard_path(filename, 1) for filename in ['grey_120.png'] + filenames))
+
+    def test_async_api(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        current_app.config['AVATARS_SAVE_PATH'] = path
+        img = Image.new(mode='RGB', size=(800, 800), color=(125, 125, 125))
+
+        async def main():
+            raw_filename = await self.real_avatars.save_avatar_async(img)
+            cropped = await self.real_avatars.crop_avatar_async(raw_filename, x=1, y=1, w=100, h=100)
+            generated = await Identicon().generate_async('grey')
+            return [raw_filename] + cropped + generated
+
+        with ThreadPoolExecutor(2) as executor:
+            current_app.config['AVATARS_EXECUTOR'] = executor
+            filenames = asyncio.run(main())
+
+        self.assertEqual(filenames[-3:], ['grey_s.png', 'grey_m.png', 'grey_l.png'])
+        for filename in filenames:
+            self.assertTrue(os.path.exists(os.path.join(path, filename)))
+        with Image.open(os.path.join(path, filenames[1])) as file_s:
+            self.assertEqual(file_s.size[0], current_app.config['AVATARS_SIZE_TUPLE'][0])
+
+        # the raw file is opened once for the header, then once to crop
+        current_app.config['AVATARS_EXECUTOR'] = None
+        with mock.patch.object(Image, 'open', side_effect=Image.open) as open_:
+            asyncio.run(self.real_avatars.crop_avatar_async(filenames[0], x=1, y=1, w=100, h=100))
+        self.assertEqual(open_.call_count, 2)
+
+        # the files named after the raw file or the text are written as the sync versions do
+        current_app.config['AVATARS_LOCK_PATH'] = os.path.join(path, 'locks')
+        self.addCleanup(current_app.config.update, AVATARS_LOCK_PATH=None)
+        with mock.patch.object(SingleFlight, 'do', autospec=True, side_effect=SingleFlight.do) as do:
+            cropped = asyncio.run(self.real_avatars.crop_avatar_async(filenames[0], 1, 1, 100, 100,
+                                                                      uuid_filename=False))
+            asyncio.run(Identicon().generate_async('grey'))
+        self.assertEqual(cropped, [filenames[0] + suffix for suffix in ('_s.png', '_m.png', '_l.png')])
+        self.assertEqual([call[0][1][0] for call in do.call_args_list], ['crop', 'identicon'])
+        self.assertTrue(os.listdir(os.path.join(path, 'locks')))
+
+    def test_dedupe_uploads(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        current_app.config['AVATARS_SAVE_PATH'] = path
+        current_app.config['AVATARS_DEDUPE_INDEX'] = os.path.join(path, 'dedupe.sqlite')
+        self.addCleanup(current_app.config.update, AVATARS_DEDUPE_INDEX=None)
+        img = Image.open(os.path.join(basedir, 'flask_avatars', 'static', 'default', 'default_l.jpg'))
+
+        def upload(image, **kwargs):
+            stream = BytesIO()
+            image.save(stream, format='jpeg', **kwargs)
+            stream.seek(0)
+            return FileStorage(stream, 'avatar.jpg')
+
+        raw = self.real_avatars.save_avatar(upload(img))
+        # re-encoded and resized copies are near-duplicates
+        self.assertEqual(self.real_avatars.save_avatar(upload(img, quality=30)), raw)
+        self.assertEqual(self.real_avatars.save_avatar(img.resize((1000, 1000))), raw)
+        self.assertNotEqual(self.real_avatars.save_avatar(Image.open(os.path.join(basedir, 'screenshots',
+                                                                                  'robohash.png'))), raw)
+        # a flat red image and a flat blue image have the same hash, but not the same color
+        red = self.real_avatars.save_avatar(Image.new('RGB', (100, 100), (255, 0, 0)))
+        self.assertNotEqual(self.real_avatars.save_avatar(Image.new('RGB', (100, 100), (0, 0, 255))), red)
+
+        # images with close hashes are only candidates, different initials are never reused
+        current_app.config['AVATARS_DEDUPE_THRESHOLD'] = 16
+        self.addCleanup(current_app.config.update, AVATARS_DEDUPE_THRESHOLD=0)
+
+        def initials(text):
+            image = Image.new('RGB', (200, 200), (70, 130, 180))
+            ImageDraw.Draw(image).text((80, 90), text, fill=(255, 255, 255))
+            return image
+
+        ab = self.real_avatars.save_avatar(initials('AB'))
+        self.assertNotEqual(self.real_avatars.save_avatar(initials('XY')), ab)
+        self.assertEqual(self.real_avatars.save_avatar(upload(initials('AB'), quality=30)), ab)
+        # the decoding of the fingerprint is admitted by the limiter
+        admitted = self.real_avatars.limiter.metrics['admitted']
+        self.real_avatars.save_avatar(upload(img))
+        self.assertGreater(self.real_avatars.limiter.metrics['admitted'], admitted)
+
+        filenames = self.real_avatars.crop_avatar(raw, 10, 10, 100, 100)
+        self.assertEqual(self.real_avatars.crop_avatar(raw, 10, 10, 100, 100), filenames)
+        self.assertNotEqual(self.real_avatars.crop_avatar(raw, 20, 20, 100, 100), filenames)
+        self.assertEqual(asyncio.run(self.real_avatars.crop_avatar_async(raw, 10, 10, 100, 100)), filenames)
+        # the raw file is shared, the variants aren't named after it
+        self.assertEqual(self.real_avatars.crop_avatar(raw, 10, 10, 100, 100, uuid_filename=False), filenames)
+        self.assertFalse(os.path.exists(os.path.join(path, raw + '_s.png')))
+
+        # a removed variant is cropped again
+        os.remove(os.path.join(path, filenames[0]))
+        filenames = self.real_avatars.crop_avatar(raw, 10, 10, 100, 100)
+        self.assertTrue(os.path.exists(os.path.join(path, filenames[0])))
+        # the raw upload was cleaned up, the next copy is saved again without the old variants
+        os.remove(os.path.join(path, raw))
+        new_raw = asyncio.run(self.real_avatars.save_avatar_async(upload(img)))
+        self.assertNotEqual(new_raw, raw)
+        self.assertTrue(os.path.exists(os.path.join(path, new_raw)))
+        self.assertNotEqual(self.real_avatars.crop_avatar(new_raw, 10, 10, 100, 100), filenames)
+
+    def test_identicon_stream(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        current_app.config['AVATARS_SAVE_PATH'] = path
+
+        avatar = Identicon()
+        image = avatar.get_image('grey', 60, 60)
+        view = avatar.get_image('grey', 60, 60, as_memoryview=True)
+        self.assertIsInstance(view, memoryview)
+        self.assertEqual(view, image)
+        stream = BytesIO()
+        self.assertIsNone(avatar.get_image('grey', 60, 60, stream=stream))
+        self.assertEqual(stream.getvalue(), image)
+
+        avatar.generate(text='grey')
+        self.assertEqual(sorted(os.listdir(path)), ['grey_l.png', 'grey_m.png', 'grey_s.png'])
+        with open(os.path.join(path, 'grey_m.png'), 'rb') as f:
+            self.assertEqual(f.read(), avatar.get_image('grey', 60, 60, pad=6))
+
+    def test_atomic_open(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        target = os.path.join(path, 'grey_s.png')
+        with atomic_open(target) as f:
+            f.write(b'old')
+        try:
+            with atomic_open(target) as f:
+                f.write(b'new')
+                raise RuntimeError('crash')
+        except RuntimeError:
+            pass
+        self.assertEqual(os.listdir(path), ['grey_s.png'])
+        with open(target, 'rb') as f:
+            self.assertEqual(f.read(), b'old')
+        # the same permissions as open(), the umask was respected
+        with open(os.path.join(path, 'plain.png'), 'wb'):
+            pass
+        self.assertEqual(os.stat(target).st_mode & 0o777, os.stat(os.path.join(path, 'plain.png')).st_mode & 0o777)
+
+    def test_single_flight(self):
+        flights = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def render():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'rendered'
+
+        with ThreadPoolExecutor(4) as executor:
+            leader = executor.submit(flights.do, 'grey', render)
+            started.wait(5)
+            followers = [executor.submit(flights.do, 'grey', render) for i in range(3)]
+            time.sleep(0.05)
+            release.set()
+            results = [leader.result()] + [f.result() for f in followers]
+        self.assertEqual(results, ['rendered'] * 4)
+        self.assertEqual(len(calls), 1)
+
+    def test_identicon_single_flight(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        current_app.config['AVATARS_CACHE'] = DictCache()
+        current_app.config['AVATARS_LOCK_PATH'] = os.path.join(path, 'locks')
+
+        avatar = Identicon()
+        render = avatar._render
+        calls = []
+
+        def slow_render(*args):
+            calls.append(1)
+            time.sleep(0.1)
+            return render(*args)
+
+        avatar._render = slow_render
+        with ThreadPoolExecutor(4) as executor:
+            images = list(executor.map(lambda i: avatar.get_image('grey', 60, 60), range(4)))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(set(images)), 1)
+        self.assertTrue(os.listdir(os.path.join(path, 'locks')))
+
+        # the file lock and the render lock share a stripe, the nested one isn't taken again
+        renderer = IdenticonRenderer(fg_color=(200, 100, 100), bg_color=(240, 240, 240), cache=DictCache(),
+                                     lock_path=os.path.join(path, 'locks'))
+        results = []
+        with mock.patch('flask_avatars.utils.LOCK_STRIPES', 1):
+            thread = threading.Thread(target=lambda: results.append(renderer.generate('user244', save_path=path)),
+                                      daemon=True)
+            thread.start()
+            thread.join(10)
+        self.assertEqual(results, [['user244_s.png', 'user244_m.png', 'user244_l.png']])
+
+    def test_identicon_renderer(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        renderer = IdenticonRenderer(rows=5, cols=5, fg_color=(200, 100, 100), bg_color=(240, 240, 240),
+                                     cache=SQLiteCache(os.path.join(path, 'cache.db')))
+        image = renderer.get_image('grey', 60, 60)
+
+        clone = pickle.loads(pickle.dumps(renderer))
+        self.assertEqual(clone.cache.path, renderer.cache.path)
+        results = []
+        thread = threading.Thread(  # no application context in a new thread
+            target=lambda: results.append(clone.generate('grey', save_path=path, sizes=(20, 60, 100), shard_depth=1)))
+        thread.start()
+        thread.join()
+
+        self.assertEqual(results, [['grey_s.png', 'grey_m.png', 'grey_l.png']])
+        with open(os.path.join(path, shard_path('grey_m.png', 1)), 'rb') as f:
+            self.assertEqual(f.read(), clone.get_image('grey', 60, 60, pad=6))
+        self.assertEqual(clone.get_image('grey', 60, 60), image)
+        self.assertIsInstance(Identicon(), IdenticonRenderer)
+
+        # a cache with a lock can't go to a process pool, refused before rendering
+        renderer = IdenticonRenderer(cache=DictCache())
+        with ProcessPoolExecutor(1) as executor:
+            with self.assertRaises(TypeError):
+                asyncio.run(renderer.generate_async('grey', save_path=path, executor=executor))
+
+    def test_identicon_grid(self):
+        default = IdenticonRenderer(fg_color=(200, 100, 100), bg_color=(240, 240, 240))
+        self.assertEqual(default.get_image('grey', 60, 60), default.get_image('grey', 60, 60))
+        self.assertNotEqual(default.get_image('grey', 60, 60), default.get_image('li', 60, 60))
+        for rows, cols in ((20, 20), (8, 3), (10, 4), (3, 12), (64, 64)):
+            renderer = IdenticonRenderer(rows=rows, cols=cols)
+            matrix = renderer._create_matrix(renderer._string_to_byte_list('grey'))
+            self.assertEqual((len(matrix), len(matrix[0])), (rows, cols))
+            for row in matrix:  # mirrored
+                self.assertEqual(row, row[::-1])
+            self.assertTrue(any(any(row) for row in matrix))
+            with Image.open(BytesIO(renderer.get_image('grey', 150, 150, pad=15))) as img:
+                self.assertEqual(img.size, (180, 180))
+        self.assertRaises(ValueError, IdenticonRenderer, rows=0)
+
+    def test_identicon_palette(self):
+        renderer = IdenticonRenderer(fg_color=(200, 100, 100), bg_color=(240, 240, 240))
+        data = renderer.get_image('grey', 60, 60, pad=6)
+        self.assertEqual(data[24], 1)  # the bit depth in PNG header
+        with Image.open(BytesIO(data)) as img:
+            self.assertEqual(img.mode, 'P')
+            self.assertEqual(sorted(color for _, color in img.convert('RGB').getcolors()),
+                             [(200, 100, 100), (240, 240, 240)])
+            matrix = renderer._create_matrix(renderer._string_to_byte_list('grey'))
+            expected = renderer._draw_image(matrix, 60, 60, 6).convert('RGB')
+            self.assertEqual(img.convert('RGB').tobytes(), expected.tobytes())
+
+    def test_warm_up(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        cache = DictCache()
+        self.app.config.update(AVATARS_CACHE=cache, AVATARS_SAVE_PATH=path, AVATARS_WARMUP_INTERVAL=0,
+                               AVATARS_IDENTICON_FG=(200, 100, 100), AVATARS_IDENTICON_BG=(240, 240, 240))
+        warm_up = self.real_avatars.warm_up(['grey', 'li', ''])
+        self.assertTrue(warm_up.join(10))
+        self.assertEqual(warm_up.progress['done'], 2)
+        self.assertEqual(warm_up.progress['total'], 3)
+        self.assertFalse(warm_up.running)
+        self.assertGreater(warm_up.elapsed, 0)
+        renderer = Identicon()
+        key = renderer._cache_key('grey', 60, 60, 6)
+        self.assertIsNotNone(cache.get(key))
+        self.assertEqual(renderer.get_image('grey', 60, 60, 6), cache.get(key))
+        self.assertEqual(os.listdir(path), [])  # only the cache was warmed
+
+        # random colors are never hit in the cache
+        self.app.config.update(AVATARS_IDENTICON_FG=None, AVATARS_IDENTICON_BG=None)
+        with self.assertLogs(self.app.logger, 'WARNING'):
+            self.assertTrue(self.real_avatars.warm_up(['grey']).join(10))
+
+        # without a cache, the missing files were generated
+        self.app.config['AVATARS_CACHE'] = None
+        texts = os.path.join(path, 'texts.txt')
+        with open(texts, 'w') as f:
+            f.write('grey\n\nli\n')
+        warm_up = self.real_avatars.warm_up(texts)
+        self.assertTrue(warm_up.join(10))
+        self.assertEqual(warm_up.progress['done'], 2)
+        self.assertIsNone(warm_up.progress['total'])
+        self.assertIn('li_l.png', os.listdir(path))
+
+        warm_up = self.real_avatars.warm_up(lambda: iter(['grey']), sizes=(30,))
+        self.assertTrue(warm_up.join(10))
+        self.assertEqual((warm_up.done, warm_up.failed), (1, 0))